@@ -3,16 +3,41 @@ sys.path.append("../../../")
 from src.diffusion_policy.common.replay_buffer import ReplayBuffer
 import numpy as np
 import copy
+import itertools
 import os
+import shutil
+import time
 import zarr
 from termcolor import cprint
-from demo_generation.mask_util import restore_and_filter_pcd
-import imageio
+from demo_generation.mask_util import restore_and_filter_pcd, label_points_by_masks
+from demo_generation.segmentation import SegmentationCache
+from demo_generation.resample import resample_points
+from demo_generation.sampling import QMC_MODES, PREFIX_STABLE_MODES, sample_unit_cube, scale_to_range
+from demo_generation.render import PointCloudRenderer, VideoRenderQueue, report_videos
+from demo_generation.mask_store import MaskStore
 from scipy.spatial import cKDTree
 from tqdm import tqdm
-from matplotlib.ticker import FixedLocator, FormatStrFormatter
-import matplotlib.pyplot as plt
-import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from demo_generation import sharding
+from demo_generation.writer import EpisodeWriter, Hdf5EpisodeWriter, BackgroundWriter, save_hdf5, report_exports, disk_size, ZARR_KEYS, CHUNK_LEN
+from demo_generation.manifest import ResumableStore, config_hash, hash_arrays, episode_record
+from demo_generation.profiling import StageTimer
+
+
+# DemoGen instance and generation settings shared with the forked shard workers
+_shard_context = None
+
+
+def _init_shard_worker(context):
+    global _shard_context
+    _shard_context = context
+
+
+def _run_shard_worker(shard_idx, frame_range, seed):
+    generator, episodes_fn_name, trans_vectors, jobs, episode_ends, shard_dir, render_video = _shard_context
+    episodes_fn = getattr(generator, episodes_fn_name)
+    return generator._generate_shard(episodes_fn, trans_vectors, jobs, episode_ends, frame_range, shard_dir, shard_idx, seed, render_video)
 
 
 class DemoGen:
@@ -21,22 +46,58 @@ class DemoGen:
         self.source_name = cfg.source_name
         
         self.task_n_object = cfg.task_n_object
+        # the objects manipulated one after another, each with a mask name and a translation range
+        if "object_names" in cfg:
+            self.object_names = list(cfg.object_names)
+        else:
+            assert self.task_n_object in [1, 2], "object_names must be set for tasks with more than 2 objects"
+            self.object_names = ["object", "target"][:self.task_n_object]
         self.use_linear_interpolation = cfg.use_linear_interpolation
         self.interpolate_step_size = cfg.interpolate_step_size
 
         self.use_manual_parsing_frames = cfg.use_manual_parsing_frames
         self.parsing_frames = cfg.parsing_frames
         self.mask_names = cfg.mask_names
+        # decoded SAM masks of the source episodes being parsed, evicted once the episode is segmented
+        self.masks = MaskStore(os.path.join(self.data_root, "sam_mask", self.source_name), self.mask_names)
+        # error bound of the chamfer distances used by automatic parsing, None for the exact distance
+        self.chamfer_max_error = cfg.get("chamfer_max_error", None)
+        # frames skipped between the distance checks of automatic parsing before refining by binary search, 1 for a linear scan
+        self.parsing_stride = cfg.get("parsing_stride", 8)
 
         self.gen_name = cfg.generation.range_name
-        self.object_trans_range = cfg.trans_range[self.gen_name]["object"]
-        self.target_trans_range = cfg.trans_range[self.gen_name]["target"]
+        self.trans_ranges = [cfg.trans_range[self.gen_name][name] for name in self.object_names]
 
         self.n_gen_per_source = cfg.generation.n_gen_per_source
         self.render_video = cfg.generation.render_video
         if self.render_video:
-            cprint("[NOTE] Rendering video is enabled. It takes ~10s to render a single generated trajectory.", "yellow")
+            cprint("[NOTE] Rendering video is enabled. It takes ~1-2s to render a single generated trajectory.", "yellow")
+        # render the videos of every k-th variant of each source demo, e.g. one per grid row with k = sqrt(n_gen_per_source) in two-stage grid mode
+        self.render_every = cfg.generation.get("render_every", 1)
+        self.render_workers = cfg.generation.get("render_workers", 1)
         self.gen_mode = cfg.generation.mode
+        self.seed = cfg.generation.get("seed", None)
+        self.n_workers = cfg.generation.get("workers", 1)
+        # number of translation vectors synthesized at once, which bounds the memory held by the generation loop
+        self.batch_size = cfg.generation.get("batch_size", 16)
+        resample_cfg = cfg.generation.get("resample", {})
+        # points per generated frame, None to keep the number of points of the source demos
+        self.resample_n_points = resample_cfg.get("n_points", None)
+        self.resample_method = resample_cfg.get("method", "uniform")
+        export_cfg = cfg.generation.get("export", {})
+        self.export_formats = list(export_cfg.get("formats", ["zarr", "hdf5"]))
+        assert len(self.export_formats) > 0 and set(self.export_formats) <= {"zarr", "hdf5"}, "export formats must be zarr and/or hdf5"
+        self.hdf5_compression = export_cfg.get("hdf5_compression", "gzip")
+        self.background_export = export_cfg.get("background", True)
+        # grow one dataset across runs and only generate the episodes missing from its manifest
+        self.resume = cfg.generation.get("resume", False)
+        self.cfg_hash = config_hash(cfg) if self.resume else None
+        # time spent in each stage, reported to <save_path>_timing.json at the end of generate_demo
+        self.timer = StageTimer()
+        # source episode idx -> read-only episode views / SegmentationCache / parsing frames, filled during generation
+        self.source_episodes = {}
+        self.segmentations = {}
+        self.source_frames = {}
 
         source_zarr = os.path.join(self.data_root, "datasets", "source", self.source_name + ".zarr")
         self._load_from_zarr(source_zarr)
@@ -52,6 +113,8 @@ class DemoGen:
         """
         Argument: trans_range: (2, 3)
             [[x_min, y_min, z_min], [x_max, y_max, z_max]]
+        mode: "grid", "random", or one of the evenly covering samplers "sobol", "halton", "lhs", "poisson" (see `sample_unit_cube`),
+            which accept any n_demos and are seeded from np.random
         Return: A list of translation vectors. (n_demos, 3)
         """
         x_min, x_max, y_min, y_max = trans_range[0][0], trans_range[1][0], trans_range[0][1], trans_range[1][1]
@@ -72,6 +135,8 @@ class DemoGen:
                 y = np.random.random() * (y_max - y_min) + y_min
                 xyz.append([x, y, 0])
             return np.array(xyz)
+        elif mode in QMC_MODES:
+            return scale_to_range(sample_unit_cube(n_demos, 2, mode, seed=np.random.randint(2**31)), trans_range)
         else:
             raise NotImplementedError
         
@@ -98,18 +163,26 @@ class DemoGen:
     
     def get_objects_pcd_from_sam_mask(self, pcd, demo_idx, object_or_target="object"):
         assert object_or_target in ["object", "target"]
-        mask = imageio.imread(os.path.join(self.data_root, f"sam_mask/{self.source_name}/{demo_idx}/{self.mask_names[object_or_target]}.jpg"))
-        mask = mask > 128
+        mask = self.masks.get(demo_idx, object_or_target)
         filtered_pcd = restore_and_filter_pcd(pcd, mask)
         return filtered_pcd
+
+    def get_objects_labels_from_sam_masks(self, pcds, demo_idx, names=("object", "target")):
+        """
+        Label the points of one or all frames with the SAM masks of several objects at once.
+        pcds: (n, 6) or (T, n, 6)
+        :return: (n,) or (T, n) labels, k+1 for the points of names[k] and 0 for the rest. Points in several masks go to the first one.
+        """
+        return label_points_by_masks(pcds, self.masks.label_image(demo_idx, names))
     
     def generate_demo(self):
-        if self.task_n_object == 1:
-            self.one_stage_augment(self.n_gen_per_source, self.render_video, self.gen_mode)
-        elif self.task_n_object == 2:
-            self.two_stage_augment(self.n_gen_per_source, self.render_video, self.gen_mode)
-        else:
-            raise NotImplementedError
+        if self.seed is not None:
+            # the translation samplers and the point resampling all draw from np.random
+            np.random.seed(self.seed)
+        self.timer = StageTimer()
+        save_path = self.augment(self.n_gen_per_source, self.render_video, self.gen_mode)
+        self.timer.save(save_path.replace(".zarr", "_timing.json"), source_name=self.source_name, range_name=self.gen_name,
+                        mode=self.gen_mode, n_gen_per_source=self.n_gen_per_source, workers=self.n_workers)
         
     def parse_frames_two_stage(self, pcds, demo_idx, ee_poses, distance_mode="ee2pcd", threshold_1=0.15, threshold_2=0.235, threshold_3=0.275,):
         """
@@ -119,431 +192,491 @@ class DemoGen:
         Since DemoGen requires very few source demos, it is also feasible (actually recommended) to manually specify the frames for parsing.
         To manually decide the parsing frames, you can set the translation vectors to zero, run the DemoGen code, render the videos, and check the
             frame_idx on the left top of the video.
+        The objects stay still until they are touched, so they are segmented once on the first frame, and each stage transition is
+            located by `first_frame_where` instead of a scan over all frames.
         """
         assert distance_mode in ["ee2pcd", "pcd2pcd"]
-        stage = 1
-        for i in range(pcds.shape[0]):
-            object_pcd = self.get_objects_pcd_from_sam_mask(pcds[i], demo_idx, "object")
-            target_pcd = self.get_objects_pcd_from_sam_mask(pcds[i], demo_idx, "target")
-            if stage == 1:
-                if distance_mode == "ee2pcd":            
-                    if self.average_distance_to_point_cloud(ee_poses[i], object_pcd) <= threshold_1:
-                        # visualizer.visualize_pointcloud(pcds[i])
-                        stage = 2
-                        skill_1_frame = i
-                        object_origin_pcd = object_pcd
-                elif distance_mode == "pcd2pcd":
-                    obj_bbox = self.pcd_bbox(object_pcd)
-                    tar_bbox = self.pcd_bbox(target_pcd)
-                    source_pcd = pcds[i].copy()
-                    _, _, ee_pcd = self.pcd_divide(source_pcd, [obj_bbox, tar_bbox])
-                    if self.chamfer_distance(object_pcd, ee_pcd) <= threshold_1:
-                        stage = 2
-                        skill_1_frame = i
-                        object_origin_pcd = object_pcd
-                        
-            elif stage == 2:
-                if distance_mode == "ee2pcd":
-                    if self.average_distance_to_point_cloud(ee_poses[i], object_origin_pcd) >= threshold_2:
-                        stage = 3
-                        motion_2_frame = i
-                        # visualizer.visualize_pointcloud(pcds[i])
-                elif distance_mode == "pcd2pcd":
-                    tar_bbox = self.pcd_bbox(target_pcd)
-                    source_pcd = pcds[i].copy()
-                    _, ee_obj_pcd = self.pcd_divide(source_pcd, [tar_bbox])
-                    if self.chamfer_distance(ee_obj_pcd, object_origin_pcd) >= threshold_2:
-                        stage = 3
-                        motion_2_frame = i
-                        
-            elif stage == 3:
-                if distance_mode == "ee2pcd":
-                    if self.average_distance_to_point_cloud(ee_poses[i], target_pcd) <= threshold_3:
-                        skill_2_frame = i
-                        # visualizer.visualize_pointcloud(pcds[i])
-                        break
-                elif distance_mode == "pcd2pcd":
-                    tar_bbox = self.pcd_bbox(target_pcd)
-                    source_pcd = pcds[i].copy()
-                    _, ee_obj_pcd = self.pcd_divide(source_pcd, [tar_bbox])
-                    if self.chamfer_distance(ee_obj_pcd, target_pcd) <= threshold_3:
-                        skill_2_frame = i
-                        break
-                
+        labels = self.get_objects_labels_from_sam_masks(pcds[0], demo_idx, ["object", "target"])
+        object_pcd, target_pcd = pcds[0][labels == 1], pcds[0][labels == 2]
+        obj_bbox = self.pcd_bbox(object_pcd)
+        tar_bbox = self.pcd_bbox(target_pcd)
+        n_frames = pcds.shape[0]
+
+        if distance_mode == "ee2pcd":
+            reach_object = lambda i: self.average_distance_to_point_cloud(ee_poses[i], object_pcd) <= threshold_1
+            leave_object = lambda i: self.average_distance_to_point_cloud(ee_poses[i], object_pcd) >= threshold_2
+            reach_target = lambda i: self.average_distance_to_point_cloud(ee_poses[i], target_pcd) <= threshold_3
+        elif distance_mode == "pcd2pcd":
+            reach_object = lambda i: self.chamfer_distance(object_pcd, self.pcd_divide(pcds[i], [obj_bbox, tar_bbox])[2], self.chamfer_max_error) <= threshold_1
+            leave_object = lambda i: self.chamfer_distance(self.pcd_divide(pcds[i], [tar_bbox])[1], object_pcd, self.chamfer_max_error) >= threshold_2
+            reach_target = lambda i: self.chamfer_distance(self.pcd_divide(pcds[i], [tar_bbox])[1], target_pcd, self.chamfer_max_error) <= threshold_3
+
+        skill_1_frame = self.first_frame_where(reach_object, 0, n_frames, self.parsing_stride)
+        if skill_1_frame is None:
+            raise ValueError(f"Source demo {demo_idx}: the robot never reaches the object, try a larger threshold_1")
+        motion_2_frame = self.first_frame_where(leave_object, skill_1_frame + 1, n_frames, self.parsing_stride)
+        skill_2_frame = None
+        if motion_2_frame is not None:
+            skill_2_frame = self.first_frame_where(reach_target, motion_2_frame + 1, n_frames, self.parsing_stride)
+
         print(f"Stage 1: {skill_1_frame}, Pre-2: {motion_2_frame}, Stage 2: {skill_2_frame}")
         return skill_1_frame, motion_2_frame, skill_2_frame
 
-    def two_stage_augment(self, n_demos, render_video=False, gen_mode='random'):
+    @staticmethod
+    def first_frame_where(condition, start, end, stride=1):
+        """
+        First frame in [start, end) where `condition` holds, or None.
+        The stage transitions are monotone (once the robot reaches the object, it stays close until the skill ends), so `condition` is
+            only evaluated every `stride` frames, and the first frame is then found by binary search between the last two evaluated frames.
+            This evaluates ~(end - start) / stride + log2(stride) frames instead of all of them. stride=1 is the plain linear scan.
+        """
+        last_false = start - 1
+        coarse_frames = list(range(start, end, stride))
+        if len(coarse_frames) > 0 and coarse_frames[-1] != end - 1:
+            coarse_frames.append(end - 1)
+        for i in coarse_frames:
+            if condition(i):
+                # condition(last_false) is False and condition(i) is True
+                while i - last_false > 1:
+                    mid = (last_false + i) // 2
+                    if condition(mid):
+                        i = mid
+                    else:
+                        last_false = mid
+                return i
+            last_false = i
+        return None
+
+    def parse_frames_one_stage(self, pcds, demo_idx, ee_poses, distance_mode="pcd2pcd", threshold_1=0.23):
+        assert distance_mode in ["ee2pcd", "pcd2pcd"]
+        object_pcd = self.get_objects_pcd_from_sam_mask(pcds[0], demo_idx, "object")
+        obj_bbox = self.pcd_bbox(object_pcd)
+        if distance_mode == "pcd2pcd":
+            reach_object = lambda i: self.chamfer_distance(self.pcd_divide(pcds[i], [obj_bbox])[1], object_pcd, self.chamfer_max_error) <= threshold_1
+        elif distance_mode == "ee2pcd":
+            reach_object = lambda i: self.average_distance_to_point_cloud(ee_poses[i], object_pcd) <= threshold_1
+
+        start_frame = self.first_frame_where(reach_object, 0, pcds.shape[0], self.parsing_stride)
+        if start_frame is None:
+            raise ValueError(f"Source demo {demo_idx}: the robot never reaches the object, try a larger threshold_1")
+        print(f"Stage starts at frame {start_frame}")
+        return start_frame
+
+    def augment(self, n_demos, render_video=False, gen_mode='random'):
+        """
+        An implementation of the DemoGen augmentation process for tasks that manipulate the objects of `self.object_names` one after
+            another. Every object k adds a stage of 2 sub-stages: (1) Motion-k, the robot moves towards the translated object,
+            and (2) Skill-k, the robot manipulates the object and moves with its translation vector. E.g. for ["object", "target"]:
+            (1) Motion-1, (2) Skill-1, (3) Motion-2, (4) Skill-2.
+        All stages of all translation vectors are synthesized by the same vectorized kernel, whatever the number of objects.
+        """
+        trans_vectors = self.generate_stage_trans_vectors(n_demos, gen_mode)     # [n_demos, 3 * n_objects]
+        self.prepare_sources()
+
+        if self.resume:
+            # shared by the runs with any n_demos
+            save_path = os.path.join(self.data_root, "datasets", "generated", f"{self.source_name}_{self.gen_name}.zarr")
+        else:
+            save_path = os.path.join(self.data_root, "datasets", "generated", f"{self.source_name}_{self.gen_name}_{n_demos}.zarr")
+        self._generate_and_save(self._episodes, trans_vectors, save_path, render_video)
+        return save_path
+
+    def source_episode(self, i):
         """
-        An implementation of the DemoGen augmentation process for manipulation tasks involving two objects. More specifically, the task contains
-            4 sub-stages: (1) Motion-1, (2) Skill-1, (3) Motion-2, (4) Skill-2.
-        TODO: Refactor the code to support tasks involving any number of objects and manipulation stages.
+        Read-only views of the arrays of source demo i. They are sliced from the replay buffer once, without any copy,
+            and shared by the parsing and by every batch of generated episodes.
         """
-        # Prepare translation vectors
-        trans_vectors = []      # [n_demos, 6 (obj_xyz + targ_xyz)]
+        if i not in self.source_episodes:
+            episode = {}
+            for key, value in self.replay_buffer.get_episode(i).items():
+                episode[key] = np.asarray(value).view()
+                episode[key].flags.writeable = False
+            self.source_episodes[i] = episode
+        return self.source_episodes[i]
+
+    def generate_stage_trans_vectors(self, n_demos, gen_mode='random'):
+        """
+        :return: (n_demos, 3 * n_objects) translation vectors, the xyz of each object in the order of self.object_names.
+            In grid mode, n_demos must be the n_objects-th power of a squared number, and the grids of the objects are combined.
+            The samplers of `QMC_MODES` accept any n_demos.
+        """
+        n_objects = len(self.object_names)
         if gen_mode == 'random':
+            trans_vectors = []
             for _ in range(n_demos):
-                obj_xyz = self.generate_trans_vectors(self.object_trans_range, 1, mode="random")[0]
-                targ_xyz = self.generate_trans_vectors(self.target_trans_range, 1, mode="random")[0]
-                trans_vectors.append(np.concatenate([obj_xyz, targ_xyz], axis=0))
+                trans_vectors.append(np.concatenate([self.generate_trans_vectors(trans_range, 1, mode="random")[0] for trans_range in self.trans_ranges]))
         elif gen_mode == 'grid':
-            def check_fourth_power(arr):
-                fourth_roots = np.power(arr, 1/4)
-                return np.isclose(fourth_roots, np.round(fourth_roots))
-            assert check_fourth_power(n_demos), "n_demos must be a fourth power"
-            sqrt_n_demos = int(np.sqrt(n_demos))
-            obj_xyz = self.generate_trans_vectors(self.object_trans_range, sqrt_n_demos, mode="grid")
-            targ_xyz = self.generate_trans_vectors(self.target_trans_range, sqrt_n_demos, mode="grid")
-            for o_xyz in obj_xyz:
-                for t_xyz in targ_xyz:
-                    trans_vectors.append(np.concatenate([o_xyz, t_xyz], axis=0))
+            n_per_object = int(np.round(n_demos ** (1 / n_objects)))
+            assert n_per_object ** n_objects == n_demos, f"n_demos must be the {n_objects}-th power of a squared number"
+            grids = [self.generate_trans_vectors(trans_range, n_per_object, mode="grid") for trans_range in self.trans_ranges]
+            trans_vectors = [np.concatenate(xyzs) for xyzs in itertools.product(*grids)]
+        elif gen_mode in QMC_MODES:
+            # sample the joint (x, y) space of all objects, so that the combinations of the objects are evenly covered too
+            uv = sample_unit_cube(n_demos, 2 * n_objects, gen_mode, seed=np.random.randint(2**31))
+            trans_vectors = [scale_to_range(uv[:, 2*k:2*k+2], trans_range) for k, trans_range in enumerate(self.trans_ranges)]
+            trans_vectors = np.concatenate(trans_vectors, axis=1)
         else:
             raise NotImplementedError
+        return np.array(trans_vectors).reshape(n_demos, 3 * n_objects)
 
-        generated_episodes = []
-        # For every source demo
+    def parse_frames(self, pcds, demo_idx, ee_poses):
+        """
+        :return: list of (motion_frame, skill_frame) of every stage, None for the stages missing in the demo
+        """
+        n_objects = len(self.object_names)
+        if self.use_manual_parsing_frames:
+            frames = [(0, self.parsing_frames["skill-1"])]
+            for k in range(2, n_objects + 1):
+                frames.append((self.parsing_frames.get(f"motion-{k}"), self.parsing_frames.get(f"skill-{k}")))
+        elif n_objects == 1:
+            frames = [(0, self.parse_frames_one_stage(pcds, demo_idx, ee_poses))]
+        elif n_objects == 2:
+            skill_1_frame, motion_2_frame, skill_2_frame = self.parse_frames_two_stage(pcds, demo_idx, ee_poses)
+            frames = [(0, skill_1_frame), (motion_2_frame, skill_2_frame)]
+        else:
+            raise NotImplementedError("Automatic parsing supports 1 or 2 objects, please specify the parsing frames manually")
+        return frames
+
+    def prepare_sources(self):
+        """
+        Parse and segment every source demo, after which `_episodes` can synthesize the episodes of any translation vectors.
+        """
         for i in range(self.n_source_episodes):
-            cprint(f"Generating demos for source demo {i}", "blue")
-            source_demo = self.replay_buffer.get_episode(i)
-            pcds = source_demo["point_cloud"]
-            
-            if self.use_manual_parsing_frames:
-                skill_1_frame = self.parsing_frames["skill-1"]
-                motion_2_frame = self.parsing_frames["motion-2"]
-                skill_2_frame = self.parsing_frames["skill-2"]
-            else:
-                ee_poses = source_demo["state"][:, :3]
-                skill_1_frame, motion_2_frame, skill_2_frame = self.parse_frames_two_stage(pcds, i, ee_poses)
-            print(f"Skill-1: {skill_1_frame}, Motion-2: {motion_2_frame}, Skill-2: {skill_2_frame}")
-
-            pcd_obj = self.get_objects_pcd_from_sam_mask(pcds[0], i, "object")
-            pcd_tar = self.get_objects_pcd_from_sam_mask(pcds[0], i, "target")
-            obj_bbox = self.pcd_bbox(pcd_obj)
-            tar_bbox = self.pcd_bbox(pcd_tar)
-
-            # Generate demos according to translation vectors
-            for trans_vec in tqdm(trans_vectors):
-                obj_trans_vec = trans_vec[:3]
-                tar_trans_vec = trans_vec[3:6]
-                ############## start of generating one episode ##############
-                current_frame = 0
-
-                traj_states = []
-                traj_actions = []
-                traj_pcds = []
-                trans_sofar = np.zeros(3)
-
-                ############# stage {motion-1} starts #############
-                trans_togo = obj_trans_vec.copy()
-                source_demo = self.replay_buffer.get_episode(i)
-                start_pos = source_demo["state"][0][:3] - source_demo["action"][0][:3] # home state
-                end_pos = source_demo["state"][skill_1_frame-1][:3] + trans_togo
-                
-                if self.use_linear_interpolation:
-                    step_action = (end_pos - start_pos) / skill_1_frame
-                else:
-                    xy_stage_frame = skill_1_frame
-                    step_actions = []
-                    z_action = end_pos[2] - start_pos[2]
-                    xy_action = end_pos[:2] - start_pos[:2]
-                    
-                    if z_action != 0:
-                        z_action = np.sign(z_action) * round(np.abs(z_action), 3)
-                        z_step_num = int(np.abs(z_action) / 0.015)
-                        for _ in range(z_step_num):
-                            step_actions.append(np.array([0, 0, np.sign(z_action) * 0.015]))
-                            xy_stage_frame -= 1
-                    
-                    if xy_stage_frame > 0:
-                        action = xy_action / xy_stage_frame
-                        for _ in range(xy_stage_frame):
-                            step_actions.append(np.array([*action, 0]))
-                            
-                    # inverse the step_actions
-                    step_actions = step_actions[::-1]
-                
-                for j in range(skill_1_frame):
-                    if not self.use_linear_interpolation:
-                        step_action = step_actions[j]
-                        
-                    source_action = source_demo["action"][current_frame]
-                    traj_actions.append(np.concatenate([step_action, source_action[3:]], axis=0))
-                    trans_this_frame = step_action - source_action[:3]
-                    
-                    trans_sofar[:2] += trans_this_frame[:2] # for x y only
-
-                    # "state" and "point_cloud" consider the accumulated translation
-                    state = source_demo["state"][current_frame].copy()
-                    state[:3] += trans_sofar
-                    traj_states.append(state)
-                    
-                    source_pcd = source_demo["point_cloud"][current_frame].copy()
-                    pcd_obj, pcd_tar, pcd_robot = self.pcd_divide(source_pcd, [obj_bbox, tar_bbox])
-                    # visualizer.visualize_pointcloud(pcd_robot)
-                    pcd_obj = self.pcd_translate(pcd_obj, obj_trans_vec)
-                    pcd_tar = self.pcd_translate(pcd_tar, tar_trans_vec)
-                    pcd_robot = self.pcd_translate(pcd_robot, trans_sofar)
-                    traj_pcds.append(np.concatenate([pcd_robot, pcd_obj, pcd_tar], axis=0))
-
-                    current_frame += 1
-                ############## stage {motion-1} ends #############
-                
-                ############# stage {skill-1} starts #############
-                if motion_2_frame is not None:
-                    is_stage_motion2 = current_frame >= motion_2_frame
-                else:
-                    is_stage_motion2 = current_frame > len(source_demo["action"]) - 1
-                
-                while not is_stage_motion2:
-                    action = source_demo["action"][current_frame].copy()
-                    traj_actions.append(action)
-
-                    # "state" and "point_cloud" consider the accumulated translation
-                    state = source_demo["state"][current_frame].copy()
-                    state[:3] += trans_sofar
-                    traj_states.append(state)
-                    
-                    source_pcd = source_demo["point_cloud"][current_frame].copy()
-                    pcd_tar, pcd_obj_robot = self.pcd_divide(source_pcd, [tar_bbox])
-                    pcd_tar = self.pcd_translate(pcd_tar, tar_trans_vec)
-                    pcd_obj_robot = self.pcd_translate(pcd_obj_robot, trans_sofar)
-                    traj_pcds.append(np.concatenate([pcd_obj_robot, pcd_tar], axis=0))
-
-                    current_frame += 1
-                    if motion_2_frame is not None:
-                        is_stage_motion2 = current_frame >= motion_2_frame
-                    else:
-                        is_stage_motion2 = current_frame > len(source_demo["action"]) - 1
-                ############## stage {skill-1} ends #############
-
-                if motion_2_frame is not None and skill_2_frame is not None:
-                    ############# stage {motion-2} starts #############
-                    trans_togo = tar_trans_vec - obj_trans_vec
-                    start_pos = source_demo["state"][motion_2_frame][:3] - source_demo["action"][motion_2_frame][:3]
-                    end_pos = source_demo["state"][skill_2_frame-1][:3] + trans_togo
-                    
-                    if self.use_linear_interpolation:
-                        step_action = (end_pos - start_pos) / (skill_2_frame - motion_2_frame)
-                    else:
-                        xy_stage_frame = skill_2_frame - motion_2_frame
-                        step_actions = []
-                        z_action = end_pos[2] - start_pos[2]
-                        xy_action = end_pos[:2] - start_pos[:2]
-                        
-                        if z_action != 0:
-                            z_action = np.sign(z_action) * round(np.abs(z_action), 3)
-                            z_step_num = int(np.abs(z_action) / 0.015)
-                            for _ in range(z_step_num):
-                                step_actions.append(np.array([0, 0, np.sign(z_action) * 0.015]))
-                                xy_stage_frame -= 1
-                        
-                        if xy_stage_frame > 0:
-                            action = xy_action / xy_stage_frame
-                            for _ in range(xy_stage_frame):
-                                step_actions.append(np.array([*action, 0]))
-
-                    for k in range(skill_2_frame - motion_2_frame):
-                        if not self.use_linear_interpolation:
-                            step_action = step_actions[k]
-                        source_action = source_demo["action"][current_frame]
-                        traj_actions.append(np.concatenate([step_action, source_action[3:]], axis=0))
-                        trans_this_frame = step_action - source_action[:3]
-                        
-                        trans_sofar[:2] += trans_this_frame[:2] # for x y only
-
-                        # "state" and "point_cloud" consider the accumulated translation
-                        state = source_demo["state"][current_frame].copy()
-                        state[:3] += trans_sofar
-                        traj_states.append(state)
-
-                        source_pcd = source_demo["point_cloud"][current_frame].copy()
-                        pcd_tar, pcd_obj_robot = self.pcd_divide(source_pcd, [tar_bbox])
-                        pcd_tar = self.pcd_translate(pcd_tar, tar_trans_vec)
-                        pcd_obj_robot = self.pcd_translate(pcd_obj_robot, trans_sofar)
-                        traj_pcds.append(np.concatenate([pcd_obj_robot, pcd_tar], axis=0))
-
-                        current_frame += 1
-                    ############## stage {motion-2} ends #############
-
-                ############# stage {skill-2} starts #############
-                later_frames = self.translate_all_frames(source_demo, tar_trans_vec, current_frame)
-                ############# stage {skill-2} ends #############
-
-                # TODO: fix this hard-coded thing
-                new_traj_pcds = []
-                for pcd in traj_pcds:
-                    # make sure to sample 4096 points from each pcd
-                    if len(pcd) < 4096:
-                        pcd = pcd[np.random.choice(pcd.shape[0], 4096, replace=True)]
-                    else:
-                        pcd = pcd[:4096]
-                    new_traj_pcds.append(pcd)
-                traj_pcds = new_traj_pcds
-                # ----------------------------
-                
-                generated_episode = {
-                    "state": np.concatenate([traj_states, later_frames["state"]], axis=0) if len(traj_states) > 0 else later_frames["state"],
-                    "action": np.concatenate([traj_actions, later_frames["action"]], axis=0) if len(traj_actions) > 0 else later_frames["action"],
-                    "point_cloud": np.concatenate([traj_pcds, later_frames["point_cloud"]], axis=0) if len(traj_pcds) > 0 else later_frames["point_cloud"]
-                }
-                generated_episodes.append(generated_episode)
+            self._prepare_source(i)
+
+    def _prepare_source(self, i):
+        """
+        Parse the frames of source demo i into the stage boundaries and cache its segmentation. Nothing here depends on the translation vectors.
+        """
+        source_demo = self.source_episode(i)
+        pcds = source_demo["point_cloud"]
+        n_frames = pcds.shape[0]
+        with self.timer.stage("parse"):
+            frames = self.parse_frames(pcds, i, source_demo["state"][:, :3])
+        print(", ".join(f"Motion-{k+1}: {motion_frame}, Skill-{k+1}: {skill_frame}" for k, (motion_frame, skill_frame) in enumerate(frames)))
+
+        # A stage starts at its motion frame. A stage without motion frame is dropped with all the following ones, and the skill
+        #   of a stage without skill frame starts right away.
+        stages = []
+        for motion_frame, skill_frame in frames:
+            if motion_frame is None:
+                break
+            stages.append((motion_frame, skill_frame if skill_frame is not None else motion_frame))
+        stage_ends = [motion_frame for motion_frame, _ in stages[1:]] + [n_frames]
+
+        start_time = time.perf_counter()
+        labels = self.get_objects_labels_from_sam_masks(pcds[0], i, self.object_names)
+        bboxes = [self.pcd_bbox(pcds[0][labels == k + 1]) for k in range(len(self.object_names))]
+
+        # The segmentation of a source frame does not depend on the translation vector, so it is cached once per source demo.
+        # label 0: robot (and the grasped objects), label k+1: object k, which is segmented until the robot reaches it
+        #   in its skill and from then on moves with the robot. The objects of the dropped stages are segmented in all frames.
+        active_bboxes = np.ones((n_frames, len(self.object_names)), dtype=bool)
+        for k, (_, skill_frame) in enumerate(stages):
+            active_bboxes[skill_frame:, k] = False
+        self.segmentations[i] = SegmentationCache(pcds, bboxes, active_bboxes, names=["robot", *self.object_names])
+        self.timer.add("segment", time.perf_counter() - start_time)
+        self.masks.evict(i)
+        self.source_frames[i] = [(motion_frame, skill_frame, stage_end) for (motion_frame, skill_frame), stage_end in zip(stages, stage_ends)]
+
+    def _episodes(self, i, trans_vectors, frames=None):
+        """
+        Generate the episodes of all trans_vectors [n_gen, 3 * n_objects] from source demo i.
+        frames: slice of the frames to synthesize, e.g. the observation window of a training sample, None for all frames
+        """
+        start_time = time.perf_counter()
+        source_demo = self.source_episode(i)
+        segmentation = self.segmentations[i]
+        n_gen = len(trans_vectors)
+        n_frames = segmentation.n_frames
+        object_trans = trans_vectors.reshape(n_gen, -1, 3)      # [n_gen, n_objects, 3]
 
+        source_actions = source_demo["action"]
+        source_states = source_demo["state"]
+        actions = np.repeat(source_actions[None], n_gen, axis=0)
+        # Per-frame translation of the robot points (and the state)
+        robot_trans = np.zeros((n_gen, n_frames, 3))
+        for k, (motion_frame, skill_frame, stage_end) in enumerate(self.source_frames[i]):
+            prev_trans = object_trans[:, k-1] if k > 0 else np.zeros((n_gen, 3))
+            ############# stage {motion-k}: from the previous object to object k #############
+            if skill_frame > motion_frame:
+                if k == 0:
+                    start_pos = source_states[0][:3] - source_actions[0][:3] # home state
+                else:
+                    start_pos = source_states[motion_frame][:3] - source_actions[motion_frame][:3]
+                end_pos = source_states[skill_frame-1][:3] + object_trans[:, k] - prev_trans
+                step_actions = self.motion_step_actions(start_pos, end_pos, skill_frame - motion_frame, self.use_linear_interpolation, reverse=(k == 0))
+                actions[:, motion_frame:skill_frame, :3] = step_actions
+                # "state" and "point_cloud" consider the accumulated translation, for x y only
+                robot_trans[:, motion_frame:skill_frame, :2] = prev_trans[:, None, :2] + np.cumsum(step_actions[..., :2] - source_actions[motion_frame:skill_frame, :2], axis=1)
+            ############# stage {skill-k}: the robot moves with object k #############
+            robot_trans[:, skill_frame:stage_end] = object_trans[:, k, None]
+
+        segment_trans = np.concatenate([
+            robot_trans[:, :, None],
+            np.broadcast_to(object_trans[:, None], (n_gen, n_frames, *object_trans.shape[1:])),
+        ], axis=2)      # [n_gen, n_frames, 1 + n_objects (robot, objects), 3]
+        if frames is not None:
+            # the actions and translations depend on the earlier frames, the point clouds only on their own frame
+            segment_trans, actions = segment_trans[:, frames], actions[:, frames]
+        episodes = self.synthesize_episodes(source_demo, segmentation, segment_trans, actions, frames)
+        self.timer.add("synthesize", time.perf_counter() - start_time)
+        # fixed number of points per frame
+        with self.timer.stage("resample"):
+            episodes["point_cloud"] = resample_points(episodes["point_cloud"], self.resample_n_points, self.resample_method)
+        return episodes
+
+    def _generate_and_save(self, episodes_fn, trans_vectors, save_path, render_video=False):
+        """
+        Generate the episodes of every (source demo, translation vector) pair with episodes_fn(i, trans_vectors) and save them to save_path.
+        """
+        if self.resume:
+            self._generate_resumable(episodes_fn, trans_vectors, save_path, render_video)
+            return
+        if self.n_workers > 1:
+            self._generate_sharded(episodes_fn, trans_vectors, save_path, render_video)
+            return
+
+        cprint(f"Saving data to {save_path}", "green")
+        writers = self._make_writers(save_path)
+        video_queue = self._make_video_queue(self.render_workers) if render_video else None
+        for i in range(self.n_source_episodes):
+            cprint(f"Generating demos for source demo {i}", "blue")
+            for n, generated_episode in tqdm(self._iter_episodes(episodes_fn, i, trans_vectors), total=len(trans_vectors)):
+                with self.timer.stage("write"):
+                    for writer in writers:
+                        writer.add_episode(generated_episode)
+                self._count_episode(generated_episode)
                 if render_video:
-                    vfunc = np.vectorize("{:.3f}".format)
-                    video_name = f"{i}_obj[{np.round(obj_trans_vec[0], 3)},{np.round(obj_trans_vec[1], 3)}]_tar[{np.round(tar_trans_vec[0], 3)},{np.round(tar_trans_vec[1], 3)}].mp4"
-                    video_path = os.path.join(self.data_root, "videos", self.source_name, self.gen_name, video_name)
-                    self.point_cloud_to_video(generated_episode["point_cloud"], video_path, elev=20, azim=30)
-                # self._examine_episode(generated_episode, aug_setting, i, obj_trans_vec, tar_trans_vec)
-                ############## end of generating one episode ##############
-
-        # save the generated episodes
-        save_path = os.path.join(self.data_root, "datasets", "generated", f"{self.source_name}_{self.gen_name}_{n_demos}.zarr")
-        self.save_episodes(generated_episodes, save_path)
-        
-    def parse_frames_one_stage(self, pcds, demo_idx, ee_poses, distance_mode="pcd2pcd", threshold_1=0.23):
-        assert distance_mode in ["ee2pcd", "pcd2pcd"]
-        for i in range(pcds.shape[0]):
-            object_pcd = self.get_objects_pcd_from_sam_mask(pcds[i], demo_idx, "object")
-            if distance_mode == "pcd2pcd":
-                obj_bbox = self.pcd_bbox(object_pcd)
-                source_pcd = pcds[i].copy()
-                _, pcd_ee = self.pcd_divide(source_pcd, [obj_bbox])
-                if self.chamfer_distance(pcd_ee, object_pcd) <= threshold_1:
-                    print(f"Stage starts at frame {i}")
-                    start_frame = i
-                    break
-            elif distance_mode == "ee2pcd":
-                if self.average_distance_to_point_cloud(ee_poses[i], object_pcd) <= threshold_1:
-                    print(f"Stage starts at frame {i}")
-                    start_frame = i
-                    break
-        return start_frame
+                    video_queue.submit(n, generated_episode["point_cloud"], self._video_path(i, trans_vectors[n]))
 
-    def one_stage_augment(self, n_demos, render_video=False, gen_mode='random'):
-        # Prepare translation vectors
-        trans_vectors = []      # [n_demos, 6 (obj_xyz + targ_xyz)]
-        if gen_mode == 'random':
-            trans_vectors = self.generate_trans_vectors(self.object_trans_range, n_demos, mode="random")
-        elif gen_mode == 'grid':
-            def check_squared_number(arr):
-                return np.isclose(np.sqrt(arr), np.round(np.sqrt(arr)))
-            assert check_squared_number(n_demos), "n_demos must be a squared number"
-            trans_vectors = self.generate_trans_vectors(self.object_trans_range, n_demos, mode="grid")
+        with self.timer.stage("write"):
+            export_stats = [writer.close() for writer in writers]
+        report_exports(export_stats)
+        if render_video:
+            self._report_videos([video_queue.close()])
 
+    def _count_episode(self, episode):
+        self.timer.count("episodes")
+        self.timer.count("frames", len(episode["state"]))
 
-        generated_episodes = []
+    def _report_videos(self, video_stats):
+        """
+        video_stats: list of the dicts returned by VideoRenderQueue.close
+        """
+        for stats in video_stats:
+            self.timer.add("render", stats["durations"])
+        report_videos(video_stats, self._video_dir())
 
-        for i in tqdm(range(self.n_source_episodes)):
-            cprint(f"Generating demos for source demo {i}", "blue")
-            source_demo = self.replay_buffer.get_episode(i)
-            pcds = source_demo["point_cloud"]
-            # visualizer.visualize_pointcloud(pcds[0])
-            
-            if self.use_manual_parsing_frames:
-                skill_1_frame = self.parsing_frames["skill-1"]
+    def _make_writers(self, save_path):
+        """
+        One writer per export format. The hdf5 writer runs in a background process if self.background_export.
+        """
+        writers = []
+        if "zarr" in self.export_formats:
+            writers.append(EpisodeWriter(save_path, self.zarr_compressor))
+        if "hdf5" in self.export_formats:
+            hdf5_path = save_path.replace('.zarr', '.hdf5')
+            if self.background_export:
+                writers.append(BackgroundWriter(Hdf5EpisodeWriter, hdf5_path, self.hdf5_compression))
             else:
-                ee_poses = source_demo["state"][:, :3]
-                skill_1_frame = self.parse_frames_one_stage(pcds, i, ee_poses)
-            print(f"Skill-1: {skill_1_frame}")
-            
-            pcd_obj = self.get_objects_pcd_from_sam_mask(pcds[0], i, "object")
-            obj_bbox = self.pcd_bbox(pcd_obj)
-
-            for obj_trans_vec in tqdm(trans_vectors):
-                ############## start of generating one episode ##############
-                current_frame = 0
-
-                traj_states = []
-                traj_actions = []
-                traj_pcds = []
-                trans_sofar = np.zeros(3)
-
-                ############# stage {motion-1} starts #############
-                trans_togo = obj_trans_vec.copy()
-                source_demo = self.replay_buffer.get_episode(i)
-                start_pos = source_demo["state"][0][:3] - source_demo["action"][0][:3] # home state
-                end_pos = source_demo["state"][skill_1_frame-1][:3] + trans_togo
-                
-                if self.use_linear_interpolation:
-                    step_action = (end_pos - start_pos) / skill_1_frame
-                else:
-                    xy_stage_frame = skill_1_frame
-                    step_actions = []
-                    z_action = end_pos[2] - start_pos[2]
-                    xy_action = end_pos[:2] - start_pos[:2]
-                    
-                    if z_action != 0:
-                        z_action = np.sign(z_action) * round(np.abs(z_action), 3)
-                        z_step_num = int(np.abs(z_action) / 0.015)
-                        for _ in range(z_step_num):
-                            step_actions.append(np.array([0, 0, np.sign(z_action) * 0.015]))
-                            xy_stage_frame -= 1
-                    
-                    if xy_stage_frame > 0:
-                        action = xy_action / xy_stage_frame
-                        for _ in range(xy_stage_frame):
-                            step_actions.append(np.array([*action, 0]))
-                            
-                    # inverse the step_actions
-                    step_actions = step_actions[::-1]
-                
-                for j in range(skill_1_frame):
-                    if not self.use_linear_interpolation:
-                        step_action = step_actions[j]
-                        
-                    source_action = source_demo["action"][current_frame]
-                    traj_actions.append(np.concatenate([step_action, source_action[3:]], axis=0))
-                    trans_this_frame = step_action - source_action[:3]
-                    trans_sofar[:2] += trans_this_frame[:2] # for x y only
-
-                    # "state" and "point_cloud" consider the accumulated translation
-                    state = source_demo["state"][current_frame].copy()
-                    state[:3] += trans_sofar
-                    traj_states.append(state)
-                    
-                    source_pcd = source_demo["point_cloud"][current_frame].copy()
-                    pcd_obj, pcd_robot = self.pcd_divide(source_pcd, [obj_bbox])
-                    pcd_obj = self.pcd_translate(pcd_obj, obj_trans_vec)
-                    pcd_robot = self.pcd_translate(pcd_robot, trans_sofar)
-                    traj_pcds.append(np.concatenate([pcd_robot, pcd_obj], axis=0))
-
-                    current_frame += 1
-                ############## stage {motion-1} ends #############
-                num_frames = source_demo["state"].shape[0]
-                ############# stage {skill-1} starts #############
-                while current_frame < num_frames:
-                    action = source_demo["action"][current_frame].copy()
-                    traj_actions.append(action)
-
-                    # "state" and "point_cloud" consider the accumulated translation
-                    state = source_demo["state"][current_frame].copy()
-                    state[:3] += trans_sofar
-                    traj_states.append(state)
-                    
-                    pcd_obj_robot = source_demo["point_cloud"][current_frame].copy()
-                    pcd_obj_robot = self.pcd_translate(pcd_obj_robot, trans_sofar)
-                    traj_pcds.append(pcd_obj_robot)
-
-                    current_frame += 1
-                    ############## stage {skill-1} ends #############
-
-                generated_episode = {
-                    "state": traj_states,
-                    "action": traj_actions,
-                    "point_cloud": traj_pcds
-                }
-                generated_episodes.append(generated_episode)
+                writers.append(Hdf5EpisodeWriter(hdf5_path, self.hdf5_compression))
+        return writers
 
-                if render_video:
-                    vfunc = np.vectorize("{:.3f}".format)
-                    video_name = f"{i}_obj[{np.round(obj_trans_vec[0], 3)},{np.round(obj_trans_vec[1], 3)}].mp4"
-                    video_path = os.path.join(self.data_root, "videos", self.source_name, self.gen_name, video_name)
-                    self.point_cloud_to_video(generated_episode["point_cloud"], video_path, elev=20, azim=30)
-                ############## end of generating one episode ##############
-        
-        # save the generated episodes
-        save_path = os.path.join(self.data_root, "datasets", "generated", f"{self.source_name}_{self.gen_name}_{n_demos}.zarr")
-        self.save_episodes(generated_episodes, save_path)
+    def _iter_episodes(self, episodes_fn, i, trans_vectors, n_start=0, n_end=None):
+        """
+        Yield (n, episode) for the translation vectors n_start..n_end of source demo i. Only self.batch_size episodes are
+            synthesized at once, so the memory does not grow with the number of translation vectors.
+        """
+        n_end = len(trans_vectors) if n_end is None else n_end
+        for batch_start in range(n_start, n_end, self.batch_size):
+            batch_end = min(batch_start + self.batch_size, n_end)
+            episodes = episodes_fn(i, trans_vectors[batch_start:batch_end])
+            for n in range(batch_start, batch_end):
+                yield n, {key: value[n - batch_start] for key, value in episodes.items()}
+
+    def _generate_sharded(self, episodes_fn, trans_vectors, save_path, render_video=False):
+        """
+        Shard the (source demo, translation vector) pairs across a pool of self.n_workers processes. Every worker writes a
+            zarr shard of a chunk-aligned range of frames, and the shards are merged into save_path at the end.
+        """
+        jobs = [(i, n) for i in range(self.n_source_episodes) for n in range(len(trans_vectors))]
+        episode_ends, shard_ranges = self._plan_shards(jobs)
+        shard_dir = save_path.replace(".zarr", "_shards")
+        # the hdf5 file is appended shard by shard as they complete in order, while the workers generate the next shards
+        hdf5_writer = Hdf5EpisodeWriter(save_path.replace('.zarr', '.hdf5'), self.hdf5_compression) if "hdf5" in self.export_formats else None
+        shard_paths, video_stats = [], []
+        n_exported = 0
+        for (_, end), (shard_path, shard_video_stats) in zip(shard_ranges, self._run_shards(episodes_fn, trans_vectors, jobs, episode_ends, shard_ranges, shard_dir, render_video)):
+            if hdf5_writer is not None:
+                shard_data = zarr.open_group(shard_path, mode='r')['data']
+                n_complete = int(np.searchsorted(episode_ends, end, side="right"))
+                with self.timer.stage("write"):
+                    for block_start in range(0, shard_data[ZARR_KEYS["state"]].shape[0], 10 * CHUNK_LEN):
+                        block = slice(block_start, block_start + 10 * CHUNK_LEN)
+                        hdf5_writer.append_frames({key: shard_data[name][block] for key, name in ZARR_KEYS.items()}, episode_ends[n_exported:n_complete])
+                        n_exported = n_complete
+            shard_paths.append(shard_path)
+            video_stats.append(shard_video_stats)
+
+        stats = []
+        if hdf5_writer is not None:
+            with self.timer.stage("write"):
+                stats.append(hdf5_writer.close())
+        if "zarr" in self.export_formats:
+            os.makedirs(save_path, exist_ok=True)
+            cprint(f"Merging {len(shard_paths)} shards to {save_path}", "green")
+            start_time = time.perf_counter()
+            with self.timer.stage("write"):
+                sharding.merge_shards(shard_paths, shard_ranges, save_path, episode_ends, self.zarr_compressor)
+            cprint(f'Saved zarr file to {save_path}', 'green')
+            # the frames are compressed by the workers, the merge only moves their chunk files
+            stats.append({"format": "zarr", "path": save_path, "bytes": disk_size(save_path), "seconds": time.perf_counter() - start_time})
+        shutil.rmtree(shard_dir)
+        report_exports(stats)
+        if render_video:
+            self._report_videos(video_stats)
+
+    def _generate_resumable(self, episodes_fn, trans_vectors, save_path, render_video=False):
+        """
+        Generate only the (source demo, translation vector) pairs missing from the manifest of the dataset at save_path, and
+            append them to it. Every episode, or with several workers every shard, is committed as soon as it is written,
+            so an interrupted run is resumed from there. The dataset is always kept as zarr, as it holds the progress.
+        """
+        store = ResumableStore(save_path, self.zarr_compressor, self.cfg_hash)
+        source_hash = hash_arrays({"episode_ends": self.replay_buffer.episode_ends[:], **{key: np.asarray(value) for key, value in self.replay_buffer.items()}})
+        records = [[episode_record(source_hash, i, trans_vec, self.cfg_hash) for trans_vec in trans_vectors] for i in range(self.n_source_episodes)]
+        jobs = [(i, n) for i in range(self.n_source_episodes) for n in range(len(trans_vectors)) if records[i][n]["key"] not in store]
+        n_total = self.n_source_episodes * len(trans_vectors)
+        if self.gen_mode not in PREFIX_STABLE_MODES and len(jobs) > 0:
+            planned_keys = {record["key"] for source_records in records for record in source_records}
+            n_other = sum(record["key"] not in planned_keys for record in store.records)
+            if n_other > 0:
+                raise ValueError(f"{save_path} holds {n_other} demos that are not in the translation vectors of this run. In {self.gen_mode} "
+                                 f"mode the vectors depend on n_gen_per_source, so adding this run would mix two sets of translations. "
+                                 f"Use the n_gen_per_source of the previous runs, one of {PREFIX_STABLE_MODES} with the same "
+                                 f"generation.seed, or another dataset")
+        cprint(f"{n_total - len(jobs)} of {n_total} demos are already in {save_path}, generating {len(jobs)}", "blue")
+
+        if self.n_workers > 1 and len(jobs) > 0:
+            episode_ends, shard_ranges = self._plan_shards(jobs)
+            episode_starts = np.concatenate([[0], episode_ends[:-1]])
+            shard_dir = save_path.replace(".zarr", "_shards")
+            video_stats = []
+            n_committed = 0
+            # the shards are committed in order, as the frames of an episode may be split between consecutive shards
+            for (_, end), (shard_path, shard_video_stats) in zip(shard_ranges, self._run_shards(episodes_fn, trans_vectors, jobs, episode_ends, shard_ranges, shard_dir, render_video)):
+                shard_data = zarr.open_group(shard_path, mode='r')['data']
+                n_shard_frames = shard_data[ZARR_KEYS["state"]].shape[0]
+                n_complete = int(np.searchsorted(episode_ends, end, side="right"))
+                with self.timer.stage("write"):
+                    for block_start in range(0, n_shard_frames, 10 * CHUNK_LEN):
+                        block = slice(block_start, block_start + 10 * CHUNK_LEN)
+                        store.append_frames({key: shard_data[name][block] for key, name in ZARR_KEYS.items()})
+                    store.commit_episodes(episode_ends[n_committed:n_complete] - episode_starts[n_committed:n_complete],
+                                          [records[i][n] for i, n in jobs[n_committed:n_complete]])
+                n_committed = n_complete
+                shutil.rmtree(shard_path)
+                video_stats.append(shard_video_stats)
+            shutil.rmtree(shard_dir)
+        else:
+            video_queue = self._make_video_queue(self.render_workers) if render_video else None
+            for i, source_jobs in itertools.groupby(jobs, key=lambda job: job[0]):
+                ns = [n for _, n in source_jobs]
+                cprint(f"Generating demos for source demo {i}", "blue")
+                for j, generated_episode in tqdm(self._iter_episodes(episodes_fn, i, trans_vectors[ns]), total=len(ns)):
+                    with self.timer.stage("write"):
+                        store.add_episode(generated_episode, records[i][ns[j]])
+                    self._count_episode(generated_episode)
+                    if render_video:
+                        video_queue.submit(ns[j], generated_episode["point_cloud"], self._video_path(i, trans_vectors[ns[j]]))
+            video_stats = [video_queue.close()] if render_video else []
+
+        stats = [store.close()]
+        if "hdf5" in self.export_formats:
+            with self.timer.stage("write"):
+                stats.append(save_hdf5(save_path.replace('.zarr', '.hdf5'), save_path, self.hdf5_compression))
+        report_exports(stats)
+        if render_video:
+            self._report_videos(video_stats)
+
+    def _plan_shards(self, jobs):
+        """
+        jobs: list of (source demo, translation vector idx) of the episodes, laid out back to back in this order
+        :return: the episode ends, and the frame ranges of the shards
+        """
+        episode_lengths = self.replay_buffer.episode_lengths[[i for i, _ in jobs]]
+        episode_ends = np.cumsum(episode_lengths)
+        return episode_ends, sharding.plan_shards(episode_lengths, 4 * self.n_workers)
+
+    def _run_shards(self, episodes_fn, trans_vectors, jobs, episode_ends, shard_ranges, shard_dir, render_video=False):
+        """
+        Generate the shards in a pool of self.n_workers processes.
+        Yield (shard path, video stats) of every shard, in the order of the shards, and merge the timings of the shard.
+        """
+        os.makedirs(shard_dir, exist_ok=True)
+        seeds = np.random.randint(2**31, size=len(shard_ranges))
+        cprint(f"Generating {len(jobs)} demos in {len(shard_ranges)} shards with {self.n_workers} workers", "blue")
+        context = (self, episodes_fn.__name__, trans_vectors, jobs, episode_ends, shard_dir, render_video)
+        with ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_shard_worker, initargs=(context,)) as executor:
+            futures = [executor.submit(_run_shard_worker, k, frame_range, seed) for k, (frame_range, seed) in enumerate(zip(shard_ranges, seeds))]
+            for future in tqdm(futures):
+                shard_path, video_stats, timer_state = future.result()
+                self.timer.merge(timer_state)
+                yield shard_path, video_stats
+
+    def _generate_shard(self, episodes_fn, trans_vectors, jobs, episode_ends, frame_range, shard_dir, shard_idx, seed, render_video=False):
+        """
+        Generate the frames in frame_range of the episodes laid out back to back, and write them to a zarr shard.
+        Episode e comes from source demo jobs[e][0] and translation vector jobs[e][1].
+        The videos are rendered inside of the worker, which already runs in parallel with the other shards.
+        :return: the shard path, the video stats (None if render_video is False), and the timings of the shard
+        """
+        np.random.seed(seed)
+        # the timer forked from the main process already holds its timings
+        self.timer = StageTimer()
+        start, end = frame_range
+        episode_starts = np.concatenate([[0], episode_ends[:-1]])
+        first, last = np.searchsorted(episode_ends, start, side="right"), np.searchsorted(episode_starts, end, side="left")
+
+        shard_path = os.path.join(shard_dir, f"shard_{shard_idx:05d}.zarr")
+        writer = sharding.ShardWriter(shard_path, self.zarr_compressor)
+        video_queue = self._make_video_queue(n_workers=0) if render_video else None
+        frames = {e: slice(max(start, episode_starts[e]) - episode_starts[e], min(end, episode_ends[e]) - episode_starts[e]) for e in range(first, last)}
+        # the episodes cut by the shard boundaries are only synthesized for their frames in the shard, unless the shard renders
+        #   the video of the whole episode. They can only be the first and the last episode of the shard.
+        cut = {e for e in range(first, last) if episode_starts[e] < start or (episode_ends[e] > end and not render_video)}
+        for (i, is_cut), source_episodes in itertools.groupby(range(first, last), key=lambda e: (jobs[e][0], e in cut)):
+            source_episodes = list(source_episodes)
+            ns = [jobs[e][1] for e in source_episodes]
+            if is_cut:
+                episodes = ({key: value[0] for key, value in episodes_fn(i, trans_vectors[[n]], frames[e]).items()} for e, n in zip(source_episodes, ns))
+            else:
+                episodes = (episode for _, episode in self._iter_episodes(episodes_fn, i, trans_vectors[ns]))
+            for e, n, episode in zip(source_episodes, ns, episodes):
+                with self.timer.stage("write"):
+                    writer.append({key: value if is_cut else value[frames[e]] for key, value in episode.items()})
+                self.timer.count("frames", frames[e].stop - frames[e].start)
+                # the episode is counted and rendered by the shard where it starts
+                if episode_starts[e] >= start:
+                    self.timer.count("episodes")
+                    if render_video:
+                        video_queue.submit(n, episode["point_cloud"], self._video_path(i, trans_vectors[n]))
+        return shard_path, video_queue.close() if render_video else None, self.timer.state()
+
+    def _make_video_queue(self, n_workers):
+        return VideoRenderQueue(n_workers, self.render_every, **self.video_view)
+
+    def _video_dir(self):
+        return os.path.join(self.data_root, "videos", self.source_name, self.gen_name)
+
+    def _video_path(self, source_idx, trans_vec):
+        video_name = f"{source_idx}"
+        for k, name in enumerate(self.object_names):
+            short_name = {"object": "obj", "target": "tar"}.get(name, name)
+            video_name += f"_{short_name}[{np.round(trans_vec[3*k], 3)},{np.round(trans_vec[3*k+1], 3)}]"
+        return os.path.join(self._video_dir(), video_name + ".mp4")
 
     def _examine_episode(self, episode, aug_setting, episode_id, obj_trans, tar_trans):
         """
@@ -575,50 +708,17 @@ class DemoGen:
         print(f"ee_actions: {vfunc(ee_actions)}")
         print(f"inensity: {vfunc(intensity)}")
 
+    zarr_compressor = zarr.Blosc(cname='zstd', clevel=3, shuffle=1)
+    # view of the rendered videos
+    video_view = dict(elev=20, azim=30)
+
     def save_episodes(self, generated_episodes, save_dir):
-        os.makedirs(save_dir, exist_ok=True)
         cprint(f"Saving data to {save_dir}", "green")
-        # self.replay_buffer.save_to_store(save_dir)
-
-        zarr_root = zarr.group(save_dir)
-        zarr_data = zarr_root.create_group('data')
-        zarr_meta = zarr_root.create_group('meta')
-        state_arrays = np.concatenate([ep["state"] for ep in generated_episodes], axis=0)
-        point_cloud_arrays = np.concatenate([ep["point_cloud"] for ep in generated_episodes], axis=0)
-        action_arrays = np.concatenate([ep["action"] for ep in generated_episodes], axis=0)
-        episode_ends = []
-        count = 0
-        for ep in generated_episodes:
-            count += len(ep["state"])
-            episode_ends.append(count)
-        episode_ends_arrays = np.array(episode_ends)
-        print(episode_ends_arrays)
-
-        compressor = zarr.Blosc(cname='zstd', clevel=3, shuffle=1)
-        state_chunk_size = (100, state_arrays.shape[1])
-        point_cloud_chunk_size = (100, point_cloud_arrays.shape[1], point_cloud_arrays.shape[2])
-        action_chunk_size = (100, action_arrays.shape[1])
-        zarr_data.create_dataset('agent_pos', data=state_arrays, chunks=state_chunk_size, dtype='float32', overwrite=True, compressor=compressor)
-        zarr_data.create_dataset('point_cloud', data=point_cloud_arrays, chunks=point_cloud_chunk_size, dtype='float32', overwrite=True, compressor=compressor)
-        zarr_data.create_dataset('action', data=action_arrays, chunks=action_chunk_size, dtype='float32', overwrite=True, compressor=compressor)
-        zarr_meta.create_dataset('episode_ends', data=episode_ends_arrays, dtype='int64', overwrite=True, compressor=compressor)
-
-        cprint(f'-'*50, 'cyan')
-        # print shape
-        cprint(f'point_cloud shape: {point_cloud_arrays.shape}, range: [{np.min(point_cloud_arrays)}, {np.max(point_cloud_arrays)}]', 'green')
-        cprint(f'state shape: {state_arrays.shape}, range: [{np.min(state_arrays)}, {np.max(state_arrays)}]', 'green')
-        cprint(f'action shape: {action_arrays.shape}, range: [{np.min(action_arrays)}, {np.max(action_arrays)}]', 'green')
-        cprint(f'Saved zarr file to {save_dir}', 'green')
-
-        # save to hdf5
-        import h5py
-        save_dir = save_dir.replace('.zarr', '.hdf5')
-        with h5py.File(save_dir, 'w') as f:
-            f.create_dataset('agent_pos', data=state_arrays, compression='gzip')
-            f.create_dataset('point_cloud', data=point_cloud_arrays, compression='gzip')
-            f.create_dataset('action', data=action_arrays, compression='gzip')
-            f.create_dataset('episode_ends', data=episode_ends_arrays, compression='gzip')
-        cprint(f'Saved hdf5 file to {save_dir}', 'green')
+        writers = self._make_writers(save_dir)
+        for episode in generated_episodes:
+            for writer in writers:
+                writer.add_episode(episode)
+        report_exports([writer.close() for writer in writers])
 
     @staticmethod
     def point_cloud_to_video(point_clouds, output_file, fps=15, elev=30, azim=45):
@@ -626,61 +726,14 @@ class DemoGen:
         Converts a sequence of point cloud frames into a video.
 
         Args:
-            point_clouds (list): A list of (N, 6) numpy arrays representing the point clouds.
+            point_clouds (list or np.ndarray): A list of (N, 6) numpy arrays, or a (T, N, 6) array, representing the point clouds.
             output_file (str): The path to the output video file.
             fps (int, optional): The frames per second of the output video. Defaults to 15.
             elev (float, optional): The elevation angle (in degrees) for the 3D view. Defaults to 30.
             azim (float, optional): The azimuth angle (in degrees) for the 3D view. Defaults to 45.
         """
-        fig = plt.figure(figsize=(8, 6), dpi=300)
-        ax = fig.add_subplot(111, projection='3d')
-
-        all_points = np.concatenate(point_clouds, axis=0)
-        min_vals = np.min(all_points, axis=0)
-        max_vals = np.max(all_points, axis=0)
-
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        writer = imageio.get_writer(output_file, fps=fps)
-        logging.getLogger("imageio_ffmpeg").setLevel(logging.ERROR)
-
-        for frame, points in enumerate(point_clouds):
-            ax.clear()
-            color = points[:, 3:] / 255
-            ax.scatter(points[:, 0], points[:, 1], points[:, 2], c=color, marker='.')
-
-            ax.set_box_aspect([1.6, 2.2, 1])
-            # ax.set_box_aspect([1.6, 1.6, 1])
-            # ax.set_aspect('equal')
-            ax.set_xlim(0.1, 0.8)
-            ax.set_ylim(-0.4, 0.6)
-            # ax.set_ylim(-0.3, 0.4)
-            ax.set_zlim(0.1, 0.4)
-
-            x_ticks = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
-            y_ticks = [-0.4, -0.3, -0.2, -0.1, 0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
-            # y_ticks = [-0.3, -0.2, -0.1, 0, 0.1, 0.2, 0.3, 0.4]
-            z_ticks = [0.1, 0.2, 0.3, 0.4]
-            ax.tick_params(axis='both', which='major', labelsize=8)
-            ax.xaxis.set_major_locator(FixedLocator(x_ticks))
-            ax.yaxis.set_major_locator(FixedLocator(y_ticks))
-            ax.zaxis.set_major_locator(FixedLocator(z_ticks))
-            
-            formatter = FormatStrFormatter('%.1f')
-            ax.xaxis.set_major_formatter(formatter)
-            ax.yaxis.set_major_formatter(formatter)
-            ax.zaxis.set_major_formatter(formatter)
-
-            ax.view_init(elev=elev, azim=azim)
-            ax.text2D(0.05, 0.95, f'Frame: {frame}', transform=ax.transAxes, fontsize=14, 
-                  verticalalignment='top', bbox=dict(boxstyle='round', facecolor='white', alpha=0.7))
-            
-            fig.canvas.draw()
-            img = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)
-            img = img.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-            writer.append_data(img)
-
-        writer.close()
-        plt.close(fig)
+        renderer = PointCloudRenderer(xlim=(0.1, 0.8), ylim=(-0.4, 0.6), zlim=(0.1, 0.4), box_aspect=(1.6, 2.2, 1), elev=elev, azim=azim)
+        renderer.render_video(point_clouds, output_file, fps=fps)
 
     @staticmethod
     def pcd_divide(pcd, bbox_list):
@@ -734,15 +787,106 @@ class DemoGen:
         }
 
     @staticmethod
-    def chamfer_distance(pcd1, pcd2):
-        tree1 = cKDTree(pcd1[:, :3])
-        tree2 = cKDTree(pcd2[:, :3])
+    def motion_step_actions(start_pos, end_pos, n_frames, use_linear_interpolation=False, reverse=False):
+        """
+        Plan the ee actions of a motion segment that moves the end-effector from start_pos to end_pos in n_frames steps.
+        Without linear interpolation, the end-effector first moves along z with steps of 0.015, then in the xy plane.
+        The steps are computed in closed form, for a batch of end positions at once.
+        start_pos: (3,) or (N, 3)
+        end_pos: (3,) or (N, 3)
+        reverse: whether to reverse the order of the steps (xy first, then z)
+        :return: (n_frames, 3) step actions, or (N, n_frames, 3) for batched positions
+        """
+        batched = np.ndim(start_pos) == 2 or np.ndim(end_pos) == 2
+        delta = np.atleast_2d(np.asarray(end_pos, dtype=np.float64) - np.asarray(start_pos, dtype=np.float64))     # (N, 3)
+        if use_linear_interpolation or n_frames == 0:
+            step_actions = np.repeat((delta / max(n_frames, 1))[:, None], n_frames, axis=1)
+            return step_actions if batched else step_actions[0]
+
+        z_action = np.sign(delta[:, 2]) * np.round(np.abs(delta[:, 2]), 3)
+        # number of z steps, the rest of the frames moves in the xy plane
+        z_step_num = np.minimum(np.floor(np.abs(z_action) / 0.015).astype(int), n_frames)
+        xy_stage_frame = n_frames - z_step_num
+        frame_idx = np.arange(n_frames)[None]
+        if reverse:
+            is_z_step = frame_idx >= xy_stage_frame[:, None]
+        else:
+            is_z_step = frame_idx < z_step_num[:, None]
+
+        step_actions = np.zeros((len(delta), n_frames, 3))
+        step_actions[..., :2] = np.where(is_z_step[..., None], 0., (delta[:, :2] / np.maximum(xy_stage_frame, 1)[:, None])[:, None])
+        step_actions[..., 2] = np.where(is_z_step, np.sign(z_action)[:, None] * 0.015, 0.)
+        return step_actions if batched else step_actions[0]
+
+    @staticmethod
+    def synthesize_episodes(source_demo, segmentation, segment_trans, actions, frames=None):
+        """
+        Generate the episodes of all translation vectors from one source demo in a single broadcasted pass.
+        source_demo: dict of "state" (T, d_s) and "action" (T, d_a)
+        segmentation: SegmentationCache of the source demo, with its point clouds (T, n, 6)
+        segment_trans: (N, T, K+1, 3) translation of every segment. Segment 0 is the robot, whose translation is also applied to the state.
+        actions: (N, T, d_a) synthesized actions
+        frames: slice of the source frames that segment_trans and actions cover, None for all frames
+        :return: dict of "state" (N, T, d_s), "action" (N, T, d_a) and "point_cloud" (N, T, n, 6)
+        """
+        n_gen, n_frames = segment_trans.shape[:2]
+        frames = slice(None) if frames is None else frames
+
+        # the points of each frame grouped by segment, in the same order as concatenating the outputs of `pcd_divide`
+        source_pcds = segmentation.grouped_pcds[frames]
+        labels = segmentation.sorted_labels[frames]
 
-        distances1 = [tree2.query(point[:3], k=1)[0] for point in pcd1]
-        distances2 = [tree1.query(point[:3], k=1)[0] for point in pcd2]
+        # the translated points are written straight into the output buffer
+        point_clouds = np.empty((n_gen, *source_pcds.shape), dtype=source_pcds.dtype)
+        point_clouds[..., 3:] = source_pcds[..., 3:]
+        frame_idx = np.arange(n_frames)[:, None]
+        np.add(source_pcds[..., :3], segment_trans.astype(source_pcds.dtype)[:, frame_idx, labels], out=point_clouds[..., :3])
 
-        chamfer_dist = (np.mean(distances1) + np.mean(distances2)) / 2
+        source_states = source_demo["state"][frames]
+        states = np.empty((n_gen, *source_states.shape), dtype=source_states.dtype)
+        states[..., 3:] = source_states[..., 3:]
+        np.add(source_states[..., :3], segment_trans[:, :, 0], out=states[..., :3], casting="same_kind")
+
+        return {
+            "state": states,
+            "action": actions,
+            "point_cloud": point_clouds
+        }
+
+    @staticmethod
+    def chamfer_distance(pcd1, pcd2, max_error=None):
+        """
+        Symmetric chamfer distance between the xyz of two point clouds, with batched KD-tree queries.
+        max_error: if set, both clouds are first voxel-downsampled with a voxel size such that the result differs from
+            the exact distance by at most max_error.
+        """
+        xyz1, xyz2 = pcd1[:, :3], pcd2[:, :3]
+        weights1 = weights2 = None
+        if max_error is not None:
+            # every point is replaced by a point of its voxel, i.e. moved by at most the voxel diagonal d = sqrt(3) * voxel_size,
+            # which changes each nearest neighbor distance by at most 2d
+            voxel_size = max_error / (2 * np.sqrt(3))
+            xyz1, weights1 = DemoGen.voxel_downsample(xyz1, voxel_size)
+            xyz2, weights2 = DemoGen.voxel_downsample(xyz2, voxel_size)
+
+        distances1, _ = cKDTree(xyz2).query(xyz1, k=1, workers=-1)
+        distances2, _ = cKDTree(xyz1).query(xyz2, k=1, workers=-1)
+
+        chamfer_dist = (np.average(distances1, weights=weights1) + np.average(distances2, weights=weights2)) / 2
         return chamfer_dist
+
+    @staticmethod
+    def voxel_downsample(xyz, voxel_size):
+        """
+        Keep the first point of every occupied voxel.
+        :return: (m, 3) kept points, (m,) number of points in their voxels
+        """
+        voxels = np.floor(xyz / voxel_size).astype(np.int64)
+        voxels -= voxels.min(axis=0)
+        dims = voxels.max(axis=0) + 1
+        keys = (voxels[:, 0] * dims[1] + voxels[:, 1]) * dims[2] + voxels[:, 2]
+        _, first_idx, counts = np.unique(keys, return_index=True, return_counts=True)
+        return xyz[first_idx], counts
     
     @staticmethod
     def average_distance_to_point_cloud(target_point, point_cloud):
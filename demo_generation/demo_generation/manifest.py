@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import zarr
+from omegaconf import OmegaConf
+from termcolor import cprint
+from demo_generation.writer import ZARR_KEYS, CHUNK_LEN, disk_size
+
+
+MANIFEST_NAME = "manifest.jsonl"
+# config keys that do not change the content of a generated episode, e.g. how many episodes are generated or how they are saved
+NON_CONTENT_KEYS = ["data_root"]
+NON_CONTENT_GENERATION_KEYS = ["n_gen_per_source", "mode", "seed", "render_video", "render_every", "render_workers", "workers",
+                               "batch_size", "export", "resume"]
+
+
+def hash_arrays(arrays):
+    """
+    arrays: dict of np.ndarray
+    :return: hex sha1 of the names, dtypes, shapes and bytes of the arrays
+    """
+    sha = hashlib.sha1()
+    for name in sorted(arrays.keys()):
+        array = np.ascontiguousarray(arrays[name])
+        sha.update(f"{name}:{array.dtype.str}:{array.shape}".encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+def config_hash(cfg):
+    """
+    Hash of the settings of the config that determine the content of a generated episode.
+    """
+    container = OmegaConf.to_container(cfg, resolve=True)
+    for key in NON_CONTENT_KEYS:
+        container.pop(key, None)
+    for key in NON_CONTENT_GENERATION_KEYS:
+        container.get("generation", {}).pop(key, None)
+    return hashlib.sha1(json.dumps(container, sort_keys=True).encode()).hexdigest()
+
+
+def episode_record(source_hash, source_idx, trans_vec, cfg_hash):
+    """
+    The manifest record of the episode generated from source demo source_idx with trans_vec. Its key is the hash of all of them.
+    """
+    trans = [round(float(x), 9) for x in trans_vec]
+    key = hashlib.sha1(json.dumps([source_hash, int(source_idx), trans, cfg_hash]).encode()).hexdigest()
+    return {"key": key, "source": int(source_idx), "trans": trans, "source_hash": source_hash, "config": cfg_hash}
+
+
+class ResumableStore:
+    """
+    A zarr dataset in the layout of `DemoGen.save_episodes` that grows across runs, with a manifest in `<path>/manifest.jsonl`
+        whose line e is the record of episode e.
+    The frames are written before the episode ends and the episode ends before the manifest, so after a crash at any point
+        the dataset is cut back to the episodes listed in the manifest when it is opened again.
+    """
+    def __init__(self, path, compressor, cfg_hash, chunk_len=CHUNK_LEN):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.manifest_path = os.path.join(path, MANIFEST_NAME)
+        self.compressor = compressor
+        self.chunk_len = chunk_len
+        self.root = zarr.open_group(path, mode='a')
+        self.data = self.root.require_group('data')
+        meta = self.root.require_group('meta')
+        if 'episode_ends' not in meta:
+            meta.zeros('episode_ends', shape=(0,), chunks=(1024,), dtype=np.int64, compressor=None)
+        self.episode_ends = meta['episode_ends']
+        self.records = self._load_records()
+        self._recover()
+        configs = {record["config"] for record in self.records}
+        if len(configs - {cfg_hash}) > 0:
+            raise ValueError(f"{path} was generated with different settings, move it away or turn off generation.resume")
+        self.keys = {record["key"] for record in self.records}
+        self.n_new_episodes = 0
+        self.seconds = 0.
+
+    def _load_records(self):
+        records = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # the line being written when the run was interrupted
+                        break
+        return records
+
+    def _recover(self):
+        """
+        Cut the frames, episode ends and records that were written after the last complete episode.
+        """
+        n_episodes = min(len(self.episode_ends), len(self.records))
+        n_frames = int(self.episode_ends[n_episodes - 1]) if n_episodes > 0 else 0
+        n_dropped = len(self.episode_ends) - n_episodes
+        for array in self.data.values():
+            if array.shape[0] != n_frames:
+                array.resize((n_frames, *array.shape[1:]))
+        self.episode_ends.resize(n_episodes)
+        if len(self.records) != n_episodes:
+            self.records = self.records[:n_episodes]
+            self._write_records(self.records, mode='w')
+        if n_dropped > 0:
+            cprint(f"Dropped {n_dropped} incomplete episodes of an interrupted run from {self.path}", "yellow")
+
+    def _write_records(self, records, mode='a'):
+        with open(self.manifest_path, mode) as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    @property
+    def n_episodes(self):
+        return len(self.records)
+
+    @property
+    def n_frames(self):
+        return int(self.episode_ends[-1]) if len(self.episode_ends) > 0 else 0
+
+    def append_frames(self, data):
+        """
+        data: dict of "state", "action" and "point_cloud" arrays of consecutive frames, not yet part of a committed episode
+        """
+        start_time = time.perf_counter()
+        for key, name in ZARR_KEYS.items():
+            array = np.asarray(data[key], dtype=np.float32)
+            if name not in self.data:
+                self.data.create_dataset(name, data=array, chunks=(self.chunk_len, *array.shape[1:]), dtype='float32', compressor=self.compressor)
+            else:
+                self.data[name].append(array)
+        self.seconds += time.perf_counter() - start_time
+
+    def commit_episodes(self, episode_lengths, records):
+        """
+        Close the next len(records) episodes of the appended frames and list them in the manifest.
+        """
+        if len(records) == 0:
+            return
+        episode_ends = self.n_frames + np.cumsum(episode_lengths)
+        self.episode_ends.append(episode_ends.astype(np.int64))
+        self._write_records(records)
+        self.records.extend(records)
+        self.keys.update(record["key"] for record in records)
+        self.n_new_episodes += len(records)
+
+    def add_episode(self, episode, record):
+        self.append_frames(episode)
+        self.commit_episodes([len(episode["state"])], [record])
+
+    def close(self):
+        cprint(f"Added {self.n_new_episodes} episodes to {self.path}, {self.n_episodes} episodes in total", "green")
+        return {"format": "zarr", "path": self.path, "bytes": disk_size(self.path), "seconds": self.seconds}
@@ -0,0 +1,115 @@
+import os
+import numpy as np
+import imageio
+
+
+def flat_pixel_index(pixel_coords, width, height):
+    """
+    pixel_coords: (..., 2) int, (u, v) pixel coordinates
+    :return: (...) bool whether each pixel is inside of the image, and (...) its index in the raveled (height, width) image (0 outside)
+    """
+    u, v = pixel_coords[..., 0], pixel_coords[..., 1]
+    valid = (u >= 0) & (u < width) & (v >= 0) & (v < height)
+    return valid, np.where(valid, v * width + u, 0)
+
+
+class SamMask:
+    """
+    A decoded SAM mask together with the lookup tables used to test which pixels fall inside of it.
+    """
+    def __init__(self, image, threshold=128):
+        self.image = image
+        self.mask = image > threshold
+        self.height, self.width = self.mask.shape
+        # mask.ravel()[v * width + u] is mask[v, u]
+        self.flat_mask = np.ascontiguousarray(self.mask).ravel()
+        # flat pixel indices inside of the mask
+        self.pixel_indices = np.flatnonzero(self.flat_mask)
+
+    def contains(self, pixel_coords):
+        """
+        pixel_coords: (..., 2) int, (u, v) pixel coordinates
+        :return: (...) bool, whether each pixel is inside of the image and of the mask
+        """
+        valid, flat_idx = flat_pixel_index(pixel_coords, self.width, self.height)
+        return valid & self.flat_mask[flat_idx]
+
+
+class LabelImage:
+    """
+    The masks of several objects merged into one label image, so the points of all objects are labeled by a single lookup.
+    """
+    def __init__(self, labels):
+        """
+        labels: (H, W) int, k+1 for the pixels of object k, and 0 for the background
+        """
+        self.labels = np.asarray(labels)
+        self.height, self.width = self.labels.shape
+        self.n_objects = int(self.labels.max())
+        self.flat_labels = np.ascontiguousarray(self.labels).ravel()
+
+    @classmethod
+    def from_masks(cls, masks):
+        """
+        masks: list of K SamMask or (H, W) bool. Pixels in several masks go to the first one.
+        """
+        masks = [mask.mask if isinstance(mask, SamMask) else np.asarray(mask, dtype=bool) for mask in masks]
+        labels = np.zeros(masks[0].shape, dtype=np.uint8 if len(masks) < 256 else np.int32)
+        for k in reversed(range(len(masks))):
+            labels[masks[k]] = k + 1
+        return cls(labels)
+
+    def lookup(self, pixel_coords):
+        """
+        pixel_coords: (..., 2) int, (u, v) pixel coordinates
+        :return: (...) labels of the pixels, 0 outside of the image
+        """
+        valid, flat_idx = flat_pixel_index(pixel_coords, self.width, self.height)
+        return np.where(valid, self.flat_labels[flat_idx], 0)
+
+
+class MaskStore:
+    """
+    Load every `sam_mask/<source>/<demo_idx>/<name>.jpg` once and keep it, decoded and thresholded, until the source episode is evicted.
+    """
+    def __init__(self, mask_dir, mask_names, threshold=128):
+        """
+        mask_dir: the `sam_mask/<source>` directory
+        mask_names: maps "object" / "target" to the file name of the mask
+        """
+        self.mask_dir = mask_dir
+        self.mask_names = mask_names
+        self.threshold = threshold
+        self._masks = {}
+
+    def get(self, demo_idx, object_or_target="object"):
+        """
+        :return: SamMask
+        """
+        key = (demo_idx, object_or_target)
+        if key not in self._masks:
+            path = os.path.join(self.mask_dir, str(demo_idx), f"{self.mask_names[object_or_target]}.jpg")
+            self._masks[key] = SamMask(imageio.imread(path), self.threshold)
+        return self._masks[key]
+
+    def mask(self, demo_idx, object_or_target="object"):
+        return self.get(demo_idx, object_or_target).mask
+
+    def label_image(self, demo_idx, names=("object", "target")):
+        """
+        :return: LabelImage of the masks of `names`, label k+1 for names[k]
+        """
+        key = (demo_idx, tuple(names))
+        if key not in self._masks:
+            self._masks[key] = LabelImage.from_masks([self.get(demo_idx, name) for name in names])
+        return self._masks[key]
+
+    def evict(self, demo_idx):
+        """
+        Drop the masks of a source episode once it has been parsed and segmented.
+        """
+        for key in [key for key in self._masks if key[0] == demo_idx]:
+            del self._masks[key]
+
+    def __len__(self):
+        return len(self._masks)
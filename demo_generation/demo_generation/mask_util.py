@@ -1,7 +1,8 @@
+import copy
 import numpy as np
 from scipy.spatial.transform import Rotation as R
 from demo_generation.calibration.bimanual_bookshelf_left import *
-from src.utils.geometry.point_cloud import transform_points
+from demo_generation.mask_store import SamMask, LabelImage
 
 
 ## THE CURRENT CONFIG IS FOR THE MUG TREE TASK
@@ -93,24 +94,120 @@ def trans_pcd(points):
     
     return points
 
-def restore_and_filter_pcd(pcd_robot, mask, intrinsic_matrix=intrinsic_matrix, image_size=image_size):
-
-    # TODO:
-    # for the bimanual case, need to convert pcd_robot to pcd_world first
-    if is_bimanual:
-        _pcd_world = pcd_robot.copy()
-        _pcd_world[:, :3] = transform_points(_pcd_world[:, :3], np.linalg.inv(arm_base_T))
-        pcd_cam = restore_original_pcd(_pcd_world)
-    else:
-        pcd_cam = restore_original_pcd(pcd_robot)
-    filtered_points = filter_points_by_mask(pcd_cam, mask, intrinsic_matrix, image_size)
-    filtered_points = trans_pcd(filtered_points)
-    if is_bimanual:
-        filtered_points[:, :3] = transform_points(filtered_points[:, :3], arm_base_T)
-
-    # from src.utils.io.point_cloud import save_point_cloud_to_disk
-    # save_point_cloud_to_disk(filtered_points[:, :3], None, "pcd_cam.ply")
-    # save_point_cloud_to_disk(pcd_robot[:, :3], None, "pcd_world_robot.ply")
-    # import pdb; pdb.set_trace()
-
-    return filtered_points
+class Projector:
+    """
+    Projection of points in the robot frame to the pixels of the calibrated camera.
+    The inverse of the robot->camera chain of `restore_original_pcd` (and of the arm base transform for the bimanual setups)
+        is folded with the intrinsics into a single 3x4 matrix once, so projecting a batch of frames is a single matmul.
+    """
+    def __init__(self, robot2cam_pos, robot2cam_quat, T_link2viz, transform_realsense_util, realsense_scale, intrinsic_matrix, image_size, arm_base_T=None):
+        robot2cam_extrinsic_matrix = np.eye(4)
+        robot2cam_extrinsic_matrix[:3, :3] = R.from_quat(robot2cam_quat).as_matrix()
+        robot2cam_extrinsic_matrix[:3, 3] = robot2cam_pos
+        cam_T_points = inverse_extrinsic_matrix(transform_realsense_util) @ inverse_extrinsic_matrix(T_link2viz) @ inverse_extrinsic_matrix(robot2cam_extrinsic_matrix)
+        if arm_base_T is not None:
+            # the points are in the arm frame, convert them to the world frame first
+            cam_T_points = cam_T_points @ np.linalg.inv(arm_base_T)
+        cam_T_points[:3] /= realsense_scale
+        self.cam_T_points = cam_T_points
+        self._set_intrinsics(intrinsic_matrix, image_size)
+
+    def _set_intrinsics(self, intrinsic_matrix, image_size):
+        self.intrinsic_matrix = np.array(intrinsic_matrix)
+        self.image_size = tuple(image_size)
+        # (3, 4) robot points -> homogeneous pixels
+        self.matrix = self.intrinsic_matrix @ self.cam_T_points[:3]
+        self._rotation = np.ascontiguousarray(self.matrix[:, :3].T)
+        self._translation = self.matrix[:, 3]
+
+    @classmethod
+    def from_calibration(cls, calibration, is_bimanual=None):
+        """
+        calibration: a module of demo_generation.calibration
+        """
+        if is_bimanual is None:
+            is_bimanual = hasattr(calibration, "arm_base_T")
+        return cls(calibration.ROBOT2CAM_POS, calibration.ROBOT2CAM_QUAT, calibration.T_link2viz, calibration.transform_realsense_util,
+                   calibration.REALSENSE_SCALE, calibration.intrinsic_matrix, calibration.image_size, calibration.arm_base_T if is_bimanual else None)
+
+    def with_intrinsics(self, intrinsic_matrix, image_size):
+        projector = copy.copy(self)
+        projector._set_intrinsics(intrinsic_matrix, image_size)
+        return projector
+
+    def project(self, points):
+        """
+        points: (..., >=3) points in the robot frame, e.g. (T, N, 6) for a whole episode
+        :return: (..., 2) int pixel coordinates (u, v)
+        """
+        uvw = points[..., :3] @ self._rotation + self._translation
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pixels = np.floor(uvw[..., :2] / uvw[..., 2:])
+        return np.nan_to_num(pixels, nan=-1, posinf=-1, neginf=-1).astype(int)
+
+    def in_mask(self, points, mask):
+        """
+        points: (..., >=3) points in the robot frame
+        mask: SamMask, or (H, W) bool
+        :return: (...) bool, whether each point projects into the mask
+        """
+        pixel_coords = self.project(points)
+        if isinstance(mask, SamMask):
+            return mask.contains(pixel_coords)
+        u, v = pixel_coords[..., 0], pixel_coords[..., 1]
+        valid = (u >= 0) & (u < self.image_size[0]) & (v >= 0) & (v < self.image_size[1])
+        return valid & mask[np.where(valid, v, 0), np.where(valid, u, 0)]
+
+    def labels(self, points, label_image):
+        """
+        Label the points of any number of frames with the objects they project into, in one pass.
+        points: (..., >=3) points in the robot frame, e.g. (T, N, 6) for a whole episode
+        label_image: LabelImage, or (H, W) int with k+1 for the pixels of object k
+        :return: (...) labels, k+1 for the points of object k and 0 for the rest
+        """
+        if not isinstance(label_image, LabelImage):
+            label_image = LabelImage(label_image)
+        return label_image.lookup(self.project(points))
+
+    def filter(self, points, mask):
+        """
+        Points of a single frame that project into the mask. Restoring the camera points and transforming the kept points back
+            (`restore_original_pcd` and `trans_pcd`) is a round trip, so the kept points are returned as they are.
+        """
+        return points[self.in_mask(points, mask)]
+
+
+projector = Projector(ROBOT2CAM_POS, ROBOT2CAM_QUAT, T_link2viz, transform_realsense_util, REALSENSE_SCALE, intrinsic_matrix, image_size,
+                      arm_base_T if is_bimanual else None)
+
+
+def restore_and_filter_pcd(pcd_robot, mask, intrinsic_matrix=None, image_size=None):
+    """
+    mask: SamMask, or (H, W) bool
+    intrinsic_matrix, image_size: the calibrated ones if None
+    """
+    if intrinsic_matrix is None and image_size is None:
+        return projector.filter(pcd_robot, mask)
+    return projector.with_intrinsics(projector.intrinsic_matrix if intrinsic_matrix is None else intrinsic_matrix,
+                                     projector.image_size if image_size is None else image_size).filter(pcd_robot, mask)
+
+
+def label_points_by_masks(pcds, masks):
+    """
+    Batched version of `restore_and_filter_pcd` for whole episodes and several objects.
+    pcds: (T, N, 6) or (N, 6) point clouds in the robot frame
+    masks: LabelImage, (H, W) int label image, or list of K SamMask / (H, W) bool masks (pixels in several masks go to the first one)
+    :return: (T, N) or (N,) labels, k+1 for the points of object k and 0 for the rest
+    """
+    if isinstance(masks, (list, tuple)):
+        masks = LabelImage.from_masks(masks)
+    return projector.labels(pcds, masks)
+
+
+def label_indices(labels, label):
+    """
+    labels: (T, N) output of `label_points_by_masks`
+    :return: list of T index arrays of the points with `label` in each frame
+    """
+    frame_idx, point_idx = np.nonzero(labels == label)
+    return np.split(point_idx, np.searchsorted(frame_idx, np.arange(1, len(labels))))
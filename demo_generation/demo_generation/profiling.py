@@ -0,0 +1,109 @@
+import json
+import time
+import resource
+from contextlib import contextmanager
+import numpy as np
+from termcolor import cprint
+
+
+STAGES = ["parse", "segment", "synthesize", "resample", "render", "write"]
+# upper bounds of the duration histogram buckets, 4 per decade from 10us to 1000s, and one bucket above
+HISTOGRAM_EDGES = 10 ** np.arange(-5, 3.01, 0.25)
+
+
+class StageTimer:
+    """
+    Wall-clock time spent in each stage of the generation and counters of the generated output.
+    Every stage keeps its number of calls, total and max duration and a histogram of the durations of the calls, so the
+        memory stays constant however many calls are timed.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time)
+
+    def add(self, name, seconds):
+        """
+        seconds: duration of one call, or a list of durations of several calls
+        """
+        seconds = np.atleast_1d(np.asarray(seconds, dtype=np.float64))
+        if name not in self.stages:
+            self.stages[name] = {"calls": 0, "seconds": 0., "max": 0., "histogram": np.zeros(len(HISTOGRAM_EDGES) + 1, dtype=np.int64)}
+        stage = self.stages[name]
+        stage["calls"] += len(seconds)
+        stage["seconds"] += float(np.sum(seconds))
+        stage["max"] = max(stage["max"], float(np.max(seconds, initial=0.)))
+        np.add.at(stage["histogram"], np.searchsorted(HISTOGRAM_EDGES, seconds), 1)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def state(self):
+        """
+        Picklable state of the timer, to be merged into the timer of the main process by a worker.
+        """
+        return {"stages": self.stages, "counts": self.counts}
+
+    def merge(self, state):
+        for name, other in state["stages"].items():
+            if name not in self.stages:
+                self.stages[name] = {"calls": 0, "seconds": 0., "max": 0., "histogram": np.zeros(len(HISTOGRAM_EDGES) + 1, dtype=np.int64)}
+            stage = self.stages[name]
+            stage["calls"] += other["calls"]
+            stage["seconds"] += other["seconds"]
+            stage["max"] = max(stage["max"], other["max"])
+            stage["histogram"] += other["histogram"]
+        for name, n in state["counts"].items():
+            self.count(name, n)
+
+    def report(self, **extra):
+        """
+        :return: JSON-serializable dict of the wall time, the throughput, the peak RSS and the stages. With several workers,
+            the stage times are summed over the workers and can exceed the wall time.
+        """
+        wall_seconds = time.perf_counter() - self.start_time
+        n_episodes, n_frames = self.counts.get("episodes", 0), self.counts.get("frames", 0)
+        stages = {}
+        for name in [*STAGES, *sorted(set(self.stages) - set(STAGES))]:
+            if name not in self.stages:
+                continue
+            stage = self.stages[name]
+            upper_bounds = [*HISTOGRAM_EDGES.tolist(), None]
+            stages[name] = {
+                "calls": stage["calls"],
+                "seconds": stage["seconds"],
+                "mean_seconds": stage["seconds"] / max(stage["calls"], 1),
+                "max_seconds": stage["max"],
+                "histogram": [{"le": le, "count": int(count)} for le, count in zip(upper_bounds, stage["histogram"]) if count > 0],
+            }
+        return {
+            "wall_seconds": wall_seconds,
+            "episodes": n_episodes,
+            "frames": n_frames,
+            "episodes_per_second": n_episodes / wall_seconds,
+            "frames_per_second": n_frames / wall_seconds,
+            # ru_maxrss is in KB on Linux, the children are the shard, render and export processes
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "peak_children_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            "stages": stages,
+            "counts": dict(self.counts),
+            **extra,
+        }
+
+    def save(self, path, **extra):
+        report = self.report(**extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        stage_summary = ", ".join(f"{name} {stage['seconds']:.2f}s" for name, stage in report["stages"].items())
+        cprint(f"[timing] {report['episodes']} episodes, {report['frames']} frames in {report['wall_seconds']:.2f}s "
+               f"({report['episodes_per_second']:.2f} episodes/s, {report['frames_per_second']:.1f} frames/s), "
+               f"peak RSS {report['peak_rss_mb']:.0f} MB. {stage_summary}. Saved to {path}", "cyan")
+        return report
@@ -0,0 +1,259 @@
+import os
+import time
+import logging
+import multiprocessing
+import numpy as np
+import imageio
+from termcolor import cprint
+
+
+# 5x7 bitmaps of the characters of the frame label
+FONT_5X7 = {
+    "F": ["11111", "10000", "10000", "11110", "10000", "10000", "10000"],
+    "r": ["00000", "00000", "10110", "11001", "10000", "10000", "10000"],
+    "a": ["00000", "00000", "01110", "00001", "01111", "10001", "01111"],
+    "m": ["00000", "00000", "11010", "10101", "10101", "10101", "10101"],
+    "e": ["00000", "00000", "01110", "10001", "11111", "10000", "01110"],
+    ":": ["00000", "01100", "01100", "00000", "01100", "01100", "00000"],
+    " ": ["00000", "00000", "00000", "00000", "00000", "00000", "00000"],
+    "0": ["01110", "10001", "10011", "10101", "11001", "10001", "01110"],
+    "1": ["00100", "01100", "00100", "00100", "00100", "00100", "01110"],
+    "2": ["01110", "10001", "00001", "00010", "00100", "01000", "11111"],
+    "3": ["11111", "00010", "00100", "00010", "00001", "10001", "01110"],
+    "4": ["00010", "00110", "01010", "10010", "11111", "00010", "00010"],
+    "5": ["11111", "10000", "11110", "00001", "00001", "10001", "01110"],
+    "6": ["00110", "01000", "10000", "11110", "10001", "10001", "01110"],
+    "7": ["11111", "00001", "00010", "00100", "01000", "01000", "01000"],
+    "8": ["01110", "10001", "10001", "01110", "10001", "10001", "01110"],
+    "9": ["01110", "10001", "10001", "01111", "00001", "00010", "01100"],
+}
+FONT_5X7 = {char: np.array([[c == "1" for c in row] for row in rows]) for char, rows in FONT_5X7.items()}
+
+
+def draw_text(img, text, x, y, scale=2, color=(0, 0, 0), background=(255, 255, 255)):
+    """
+    Draw `text` with the top left corner at pixel (x, y) of img (H, W, 3), in place, on a filled box.
+    """
+    pad = scale
+    glyph_w, glyph_h = 6 * scale, 7 * scale
+    img[max(y - pad, 0):y + glyph_h + pad, max(x - pad, 0):x + glyph_w * len(text) + pad] = background
+    for i, char in enumerate(text):
+        glyph = np.kron(FONT_5X7[char], np.ones((scale, scale), dtype=bool))
+        region = img[y:y + glyph_h, x + i * glyph_w:x + i * glyph_w + 5 * scale]
+        region[glyph[:region.shape[0], :region.shape[1]]] = color
+    return img
+
+
+class PointCloudRenderer:
+    """
+    Headless software rasterizer for point cloud videos. The points are normalized into the box of the axis limits, like in
+        a matplotlib 3D axis with the same limits and box aspect, viewed from (elev, azim), and drawn as small squares with a z-buffer.
+    """
+    def __init__(self, xlim=(0.1, 0.8), ylim=(-0.4, 0.6), zlim=(0.1, 0.4), box_aspect=(1.6, 2.2, 1), elev=30, azim=45,
+                 projection="persp", image_size=(640, 480), point_size=2, margin=0.06):
+        """
+        projection: "persp" or "ortho"
+        image_size: (width, height), multiples of 16 so that ffmpeg does not resize the frames
+        """
+        assert projection in ["persp", "ortho"]
+        self.lims = np.array([xlim, ylim, zlim], dtype=np.float64).T      # (2, 3)
+        self.box_aspect = np.array(box_aspect, dtype=np.float64)
+        self.box_aspect /= np.max(self.box_aspect)
+        self.projection = projection
+        self.width, self.height = image_size
+        self.point_size = point_size
+
+        elev, azim = np.deg2rad(elev), np.deg2rad(azim)
+        eye = np.array([np.cos(elev) * np.cos(azim), np.cos(elev) * np.sin(azim), np.sin(elev)])
+        right = np.array([-np.sin(azim), np.cos(azim), 0.0])
+        up = np.cross(eye, right)
+        # box coordinates -> (right, up, towards the viewer)
+        self.view = np.stack([right, up, eye])
+        self.eye_dist = 2.5
+
+        # fit the corners of the box into the image
+        corners = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=np.float64)
+        self.box_corners = corners
+        xy, _ = self._project_box(corners - 0.5)
+        self.scale = (1 - 2 * margin) * min(self.width / np.ptp(xy[:, 0]), self.height / np.ptp(xy[:, 1]))
+        self.center = (xy.max(axis=0) + xy.min(axis=0)) / 2
+        self.background = self._draw_box()
+
+    def _project_box(self, box_points):
+        """
+        box_points: (..., 3) in [-0.5, 0.5]^3 of the axis box
+        :return: (..., 2) screen coordinates and (...) depth, larger is closer to the viewer
+        """
+        view = (box_points * self.box_aspect) @ self.view.T
+        xy, depth = view[..., :2], view[..., 2]
+        if self.projection == "persp":
+            xy = xy * (self.eye_dist / (self.eye_dist - depth))[..., None]
+        return xy, depth
+
+    def project(self, points):
+        """
+        points: (..., >=3) xyz
+        :return: (..., 2) int pixel coordinates (u, v), and (...) depth
+        """
+        box_points = (points[..., :3] - self.lims[0]) / (self.lims[1] - self.lims[0]) - 0.5
+        xy, depth = self._project_box(box_points)
+        u = (xy[..., 0] - self.center[0]) * self.scale + self.width / 2
+        v = self.height / 2 - (xy[..., 1] - self.center[1]) * self.scale
+        return np.stack([u, v], axis=-1).astype(np.int64), depth
+
+    def _draw_box(self):
+        img = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        lims = self.lims
+        t = np.linspace(0, 1, 2000)[:, None]
+        for a in range(8):
+            for b in range(a + 1, 8):
+                ca, cb = self.box_corners[a], self.box_corners[b]
+                if np.sum(ca != cb) != 1:
+                    continue
+                edge = lims[0] + (ca + (cb - ca) * t) * (lims[1] - lims[0])
+                uv, _ = self.project(edge)
+                inside = (uv[:, 0] >= 0) & (uv[:, 0] < self.width) & (uv[:, 1] >= 0) & (uv[:, 1] < self.height)
+                img[uv[inside, 1], uv[inside, 0]] = 160
+        return img
+
+    def render(self, points, uv=None, depth=None, label=None):
+        """
+        points: (N, 6) xyz rgb, rgb in [0, 255]
+        uv, depth: projection of the points, if already computed
+        :return: (H, W, 3) uint8 image
+        """
+        if uv is None:
+            uv, depth = self.project(points)
+        colors = np.clip(points[:, 3:6], 0, 255).astype(np.uint8)
+        # splat every point to a point_size x point_size square
+        offsets = np.arange(self.point_size) - self.point_size // 2
+        du, dv = np.meshgrid(offsets, offsets)
+        u = (uv[:, 0:1] + du.ravel()).ravel()
+        v = (uv[:, 1:2] + dv.ravel()).ravel()
+        point_idx = np.repeat(np.arange(len(points)), du.size)
+        inside = (u >= 0) & (u < self.width) & (v >= 0) & (v < self.height)
+        flat_pixel, point_idx = (v * self.width + u)[inside], point_idx[inside]
+        # z-buffer: keep the closest point of every pixel
+        order = np.lexsort((-depth[point_idx], flat_pixel))
+        flat_pixel, point_idx = flat_pixel[order], point_idx[order]
+        first = np.ones(len(flat_pixel), dtype=bool)
+        first[1:] = flat_pixel[1:] != flat_pixel[:-1]
+
+        img = self.background.copy()
+        img.reshape(-1, 3)[flat_pixel[first]] = colors[point_idx[first]]
+        if label is not None:
+            draw_text(img, label, int(0.05 * self.width), int(0.05 * self.height))
+        return img
+
+    def render_video(self, point_clouds, output_file, fps=15):
+        """
+        Render the frames and stream them to the video file one by one.
+        point_clouds: (T, N, 6) array or list of (N, 6) arrays
+        """
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        logging.getLogger("imageio_ffmpeg").setLevel(logging.ERROR)
+        # the encoder, not the rasterizer, dominates the rendering time
+        writer = imageio.get_writer(output_file, fps=fps, ffmpeg_params=["-preset", "ultrafast"])
+        try:
+            if isinstance(point_clouds, np.ndarray):
+                # project all the frames at once
+                uv, depth = self.project(point_clouds)
+                for frame, points in enumerate(point_clouds):
+                    writer.append_data(self.render(points, uv[frame], depth[frame], label=f"Frame: {frame}"))
+            else:
+                for frame, points in enumerate(point_clouds):
+                    writer.append_data(self.render(points, label=f"Frame: {frame}"))
+        finally:
+            writer.close()
+
+
+def _render_worker_loop(renderer_kwargs, fps, job_queue, result_queue):
+    renderer = PointCloudRenderer(**renderer_kwargs)
+    n_rendered, n_failed, durations = 0, 0, []
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        point_clouds, output_file = job
+        start_time = time.perf_counter()
+        try:
+            renderer.render_video(point_clouds, output_file, fps=fps)
+            n_rendered += 1
+        except Exception as e:
+            cprint(f"Failed to render {output_file}: {e}", "red")
+            n_failed += 1
+        durations.append(time.perf_counter() - start_time)
+    result_queue.put((n_rendered, n_failed, durations))
+
+
+class VideoRenderQueue:
+    """
+    Render the videos of generated episodes in a pool of background processes fed through a bounded queue, so that the
+        generation continues while the videos are encoded. Only every `every`-th variant is rendered.
+    With n_workers=0 the videos are rendered synchronously in submit, e.g. inside of a shard worker.
+    """
+    def __init__(self, n_workers=1, every=1, max_queue_size=None, fps=15, **renderer_kwargs):
+        self.n_workers = n_workers
+        self.every = max(int(every), 1)
+        self.fps = fps
+        self.n_queued, self.n_skipped = 0, 0
+        if n_workers == 0:
+            self.renderer = PointCloudRenderer(**renderer_kwargs)
+            self.n_rendered, self.n_failed, self.durations = 0, 0, []
+            return
+        ctx = multiprocessing.get_context("fork")
+        self.job_queue = ctx.Queue(maxsize=max_queue_size or 2 * n_workers)
+        self.result_queue = ctx.Queue()
+        self.processes = [ctx.Process(target=_render_worker_loop, args=(renderer_kwargs, fps, self.job_queue, self.result_queue), daemon=True)
+                          for _ in range(n_workers)]
+        for process in self.processes:
+            process.start()
+
+    def should_render(self, variant_idx):
+        return variant_idx % self.every == 0
+
+    def submit(self, variant_idx, point_clouds, output_file):
+        """
+        Queue the video of the variant_idx-th variant of a source demo, blocking while the queue is full.
+        """
+        if not self.should_render(variant_idx):
+            self.n_skipped += 1
+            return
+        self.n_queued += 1
+        if self.n_workers == 0:
+            start_time = time.perf_counter()
+            try:
+                self.renderer.render_video(point_clouds, output_file, fps=self.fps)
+                self.n_rendered += 1
+            except Exception as e:
+                cprint(f"Failed to render {output_file}: {e}", "red")
+                self.n_failed += 1
+            self.durations.append(time.perf_counter() - start_time)
+            return
+        self.job_queue.put((np.asarray(point_clouds), output_file))
+
+    def close(self):
+        """
+        Wait for the queued videos.
+        :return: dict of the numbers of queued, rendered, failed and skipped videos, and the render durations of the videos
+        """
+        if self.n_workers > 0:
+            for _ in self.processes:
+                self.job_queue.put(None)
+            results = [self.result_queue.get() for _ in self.processes]
+            for process in self.processes:
+                process.join()
+            self.n_rendered = sum(n_rendered for n_rendered, _, _ in results)
+            self.n_failed = sum(n_failed for _, n_failed, _ in results)
+            self.durations = [duration for _, _, durations in results for duration in durations]
+        return {"queued": self.n_queued, "rendered": self.n_rendered, "failed": self.n_failed, "skipped": self.n_skipped,
+                "durations": self.durations}
+
+
+def report_videos(stats, video_dir):
+    """
+    stats: list of the dicts returned by VideoRenderQueue.close
+    """
+    total = {key: sum(s[key] for s in stats) for key in ["queued", "rendered", "failed", "skipped"]}
+    cprint(f"[videos] {total['queued']} queued, {total['rendered']} rendered, {total['failed']} failed, {total['skipped']} skipped, "
+           f"saved to {video_dir}", "cyan")
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+RESAMPLE_METHODS = ["uniform", "first", "fps", "upsample"]
+
+
+def resample_points(point_clouds, n_points, method="uniform"):
+    """
+    Resample every frame of a batch of point clouds to n_points points, in one pass over all frames.
+    point_clouds: (..., n, d), e.g. (N, T, n, 6) generated episodes
+    n_points: number of points per frame, None to keep the points as they are
+    method:
+        "uniform": n_points points drawn uniformly without replacement
+        "first": the first n_points points. The points of the generated episodes are grouped by segment, so this drops the
+            last segments and only suits clouds whose order carries no meaning
+        "fps": farthest point sampling of the xyz (requires fpsample), one frame at a time
+        "upsample": n_points points drawn uniformly with replacement, so frames with fewer than n_points points are padded
+            with duplicated points
+        Only "upsample" accepts frames with fewer than n_points points.
+    :return: (..., n_points, d)
+    """
+    assert method in RESAMPLE_METHODS, f"resample method must be one of {RESAMPLE_METHODS}"
+    n = point_clouds.shape[-2]
+    if n_points is None or n == n_points:
+        return point_clouds
+    if method == "upsample":
+        sample_idx = np.random.choice(n, (*point_clouds.shape[:-2], n_points), replace=True)
+    elif n < n_points:
+        raise ValueError(f"Cannot resample frames of {n} points to {n_points} points without duplicating points, "
+                         f"set generation.resample.method=upsample to pad them or n_points=null to keep them as they are")
+    elif method == "first":
+        return point_clouds[..., :n_points, :]
+    elif method == "uniform":
+        sample_idx = np.argpartition(np.random.random(point_clouds.shape[:-1]), n_points - 1, axis=-1)[..., :n_points]
+    elif method == "fps":
+        try:
+            import fpsample
+        except ImportError:
+            raise ImportError("resample method 'fps' requires fpsample: pip install fpsample")
+        frames = point_clouds.reshape(-1, n, point_clouds.shape[-1])
+        sample_idx = np.stack([fpsample.bucket_fps_kdline_sampling(frame[:, :3], n_points, h=3) for frame in frames])
+        sample_idx = sample_idx.reshape(*point_clouds.shape[:-2], n_points)
+    return np.take_along_axis(point_clouds, sample_idx[..., None].astype(np.int64), axis=-2)
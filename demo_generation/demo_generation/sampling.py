@@ -0,0 +1,56 @@
+import warnings
+import numpy as np
+from scipy.stats import qmc
+
+
+QMC_MODES = ["sobol", "halton", "lhs", "poisson"]
+# modes whose first n translation vectors are the same for any number of demos >= n with the same generation.seed, so a
+# resumable dataset can be extended with a larger n_gen_per_source. The grid, lhs and poisson vectors all depend on n
+PREFIX_STABLE_MODES = ["random", "sobol", "halton"]
+
+
+def sample_unit_cube(n, d, mode, seed=None):
+    """
+    Draw n points in [0, 1)^d that cover the cube more evenly than independent uniform draws, for any n.
+    mode:
+        "sobol": scrambled Sobol' sequence, best balanced when n is a power of 2
+        "halton": scrambled Halton sequence
+        "lhs": Latin hypercube, every 1/n slice of every axis holds exactly one point
+        "poisson": Poisson-disk sampling, no two points closer than a radius shrunk until n points fit
+    seed: int or np.random.Generator
+    :return: (n, d)
+    """
+    assert mode in QMC_MODES, f"mode must be one of {QMC_MODES}"
+    if n == 0:
+        return np.empty((0, d))
+    rng = np.random.default_rng(seed)
+    if mode == "sobol":
+        engine = qmc.Sobol(d, scramble=True, seed=rng)
+        with warnings.catch_warnings():
+            # the balance warning for n not being a power of 2
+            warnings.simplefilter("ignore", UserWarning)
+            return engine.random(n)
+    elif mode == "halton":
+        return qmc.Halton(d, scramble=True, seed=rng).random(n)
+    elif mode == "lhs":
+        return qmc.LatinHypercube(d, seed=rng).random(n)
+    elif mode == "poisson":
+        # start from the radius of n disks packed in the cube and shrink it until n points fit
+        radius = 0.8 * (1 / n) ** (1 / d)
+        while True:
+            points = qmc.PoissonDisk(d, radius=radius, seed=rng).random(n)
+            if len(points) >= n:
+                return points[:n]
+            radius *= 0.85
+
+
+def scale_to_range(uv, trans_range):
+    """
+    uv: (n, 2) in [0, 1)
+    trans_range: (2, 3) [[x_min, y_min, z_min], [x_max, y_max, z_max]]
+    :return: (n, 3) translation vectors, z = 0
+    """
+    trans_range = np.asarray(trans_range, dtype=np.float64)
+    xyz = np.zeros((len(uv), 3))
+    xyz[:, :2] = trans_range[0, :2] + uv * (trans_range[1, :2] - trans_range[0, :2])
+    return xyz
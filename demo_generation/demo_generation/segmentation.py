@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def segment_frames(pcds, bbox_list, active_bboxes=None):
+    """
+    Label the points of all frames with the bboxes they fall in. Same as `DemoGen.pcd_divide`, but for a whole episode at once.
+    pcds: (T, n, 6)
+    bbox_list: list of K (2, 3), [[x_min, y_min, z_min], [x_max, y_max, z_max]]
+    active_bboxes: (T, K) bool, whether bbox k is used to divide frame t. All bboxes are used if None.
+    :return: (T, n) labels, k+1 for the points in bbox k, and 0 for the rest of the points.
+        Points in overlapping bboxes go to the first bbox.
+    """
+    labels = np.zeros(pcds.shape[:2], dtype=np.int64)
+    for k in reversed(range(len(bbox_list))):
+        bbox = np.array(bbox_list[k])
+        assert bbox.shape == (2, 3)
+        in_bbox = np.all(pcds[..., :3] > bbox[0], axis=-1) & np.all(pcds[..., :3] < bbox[1], axis=-1)
+        if active_bboxes is not None:
+            in_bbox &= active_bboxes[:, k:k+1]
+        labels[in_bbox] = k + 1
+    return labels
+
+
+class SegmentationCache:
+    """
+    Segmentation of the point clouds of one source episode into the robot (segment 0) and the objects (segments 1..K).
+    The segmentation does not depend on the translation vectors, so it is computed once per source episode and
+        shared by every episode generated from it.
+
+    The points of each frame are grouped by segment through `order`, so the points of segment k in frame t are
+        `order[t, starts[t, k]:starts[t, k+1]]`, without any per-frame masking.
+    """
+    def __init__(self, pcds, bbox_list, active_bboxes=None, names=None):
+        """
+        pcds: (T, n, 6) point clouds of the source episode
+        bbox_list: list of K (2, 3) object bboxes
+        active_bboxes: (T, K) bool, whether bbox k divides frame t, i.e. which objects are segmented at each stage.
+            Points of an inactive object are left in the robot segment, e.g. once the object is grasped.
+        names: K+1 segment names, defaults to ["robot", "object_1", ..., "object_K"]
+        """
+        n_segments = len(bbox_list) + 1
+        if names is None:
+            names = ["robot"] + [f"object_{k}" for k in range(1, n_segments)]
+        assert len(names) == n_segments
+        self.names = list(names)
+        self.bbox_list = [np.array(bbox) for bbox in bbox_list]
+
+        self.labels = segment_frames(pcds, bbox_list, active_bboxes)
+        self.order = np.argsort(self.labels, axis=1, kind="stable")
+        self.sorted_labels = np.take_along_axis(self.labels, self.order, axis=1)
+        # the source point clouds with the points of each segment contiguous, shared by all the episodes generated from them
+        self.grouped_pcds = self.group(pcds)
+        counts = np.stack([np.count_nonzero(self.labels == k, axis=1) for k in range(n_segments)], axis=1)
+        self.starts = np.concatenate([np.zeros((len(counts), 1), dtype=np.int64), np.cumsum(counts, axis=1)], axis=1)
+
+    @property
+    def n_frames(self):
+        return self.labels.shape[0]
+
+    @property
+    def n_segments(self):
+        return len(self.names)
+
+    def segment_id(self, segment):
+        return self.names.index(segment) if isinstance(segment, str) else segment
+
+    def indices(self, frame, segment):
+        """
+        Indices of the points of `segment` (name or id) in `frame` of the source episode.
+        """
+        k = self.segment_id(segment)
+        return self.order[frame, self.starts[frame, k]:self.starts[frame, k+1]]
+
+    def divide(self, pcd, frame):
+        """
+        Split the source point cloud of `frame` into the segments, in the order of `names`.
+        """
+        return [pcd[self.indices(frame, k)] for k in range(self.n_segments)]
+
+    def group(self, pcds):
+        """
+        Reorder the points of every frame so that the points of each segment are contiguous. Labels of the
+            reordered points are `sorted_labels`.
+        pcds: (T, n, d)
+        """
+        return np.take_along_axis(np.asarray(pcds), self.order[..., None], axis=1)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import numpy as np
+import zarr
+from demo_generation.writer import ZARR_KEYS, CHUNK_LEN
+
+
+def plan_shards(episode_lengths, n_shards, chunk_len=CHUNK_LEN):
+    """
+    Split the frames of all episodes, laid out back to back, into at most n_shards contiguous frame ranges.
+    Every range starts at a multiple of chunk_len, so the zarr chunks of a shard are exactly the chunks of the merged
+        dataset and merging the shards does not need to re-encode any data.
+    :return: list of (start_frame, end_frame)
+    """
+    n_frames = int(np.sum(episode_lengths))
+    n_chunks = int(np.ceil(n_frames / chunk_len))
+    shards = []
+    for chunk_ids in np.array_split(np.arange(n_chunks), min(n_shards, n_chunks)):
+        shards.append((int(chunk_ids[0]) * chunk_len, min(int(chunk_ids[-1] + 1) * chunk_len, n_frames)))
+    return shards
+
+
+class ShardWriter:
+    """
+    Append the frames of a shard to resizable zarr arrays as they are generated.
+    """
+    def __init__(self, shard_path, compressor, chunk_len=CHUNK_LEN):
+        self.shard_path = shard_path
+        self.zarr_data = zarr.group(shard_path, overwrite=True).create_group('data')
+        self.compressor = compressor
+        self.chunk_len = chunk_len
+
+    def append(self, data):
+        """
+        data: dict of "state", "action" and "point_cloud" arrays of consecutive frames
+        """
+        for key, name in ZARR_KEYS.items():
+            array = np.asarray(data[key], dtype=np.float32)
+            if name not in self.zarr_data:
+                self.zarr_data.create_dataset(name, data=array, chunks=(self.chunk_len, *array.shape[1:]), dtype='float32', compressor=self.compressor)
+            else:
+                self.zarr_data[name].append(array)
+
+
+def merge_shards(shard_paths, shard_ranges, save_dir, episode_ends, compressor, chunk_len=CHUNK_LEN):
+    """
+    Merge the shards written by `ShardWriter` into one dataset in the layout of `DemoGen.save_episodes`.
+    The chunk files of every shard are moved into the merged arrays, only `meta/episode_ends` is newly written.
+    """
+    zarr_root = zarr.group(save_dir)
+    zarr_data = zarr_root.create_group('data', overwrite=True)
+    zarr_meta = zarr_root.create_group('meta', overwrite=True)
+    n_frames = int(episode_ends[-1])
+
+    for name in ZARR_KEYS.values():
+        shard_array = zarr.open_array(os.path.join(shard_paths[0], 'data', name), mode='r')
+        zarr_data.create_dataset(name, shape=(n_frames, *shard_array.shape[1:]), chunks=shard_array.chunks, dtype='float32', overwrite=True, compressor=compressor)
+        array_dir = os.path.join(save_dir, 'data', name)
+        for shard_path, (start, _) in zip(shard_paths, shard_ranges):
+            shard_array_dir = os.path.join(shard_path, 'data', name)
+            chunk_offset = start // chunk_len
+            for chunk_key in os.listdir(shard_array_dir):
+                if chunk_key.startswith('.'):
+                    continue
+                chunk_idx, *rest = chunk_key.split('.')
+                os.replace(os.path.join(shard_array_dir, chunk_key), os.path.join(array_dir, '.'.join([str(int(chunk_idx) + chunk_offset), *rest])))
+    zarr_meta.create_dataset('episode_ends', data=np.array(episode_ends), dtype='int64', overwrite=True, compressor=compressor)
+
+    for shard_path in shard_paths:
+        shutil.rmtree(shard_path)
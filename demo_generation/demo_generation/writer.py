@@ -0,0 +1,190 @@
+import os
+import time
+import multiprocessing
+import numpy as np
+import zarr
+from termcolor import cprint
+from src.diffusion_policy.common.replay_buffer import ReplayBuffer
+
+
+# key in the generated episodes -> array name in the saved zarr
+ZARR_KEYS = {
+    "state": "agent_pos",
+    "point_cloud": "point_cloud",
+    "action": "action",
+}
+CHUNK_LEN = 100
+
+
+def disk_size(path):
+    """
+    Bytes used on disk by a file or a directory.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def hdf5_compression_kwargs(compression="gzip"):
+    """
+    Keyword arguments of `h5py.Group.create_dataset` for the hdf5 codec.
+    compression: "gzip", "lz4" (requires hdf5plugin) or None for uncompressed chunked datasets
+    """
+    if compression is None or compression == "none":
+        return {}
+    elif compression == "gzip":
+        return {"compression": "gzip"}
+    elif compression == "lz4":
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("hdf5 compression 'lz4' requires hdf5plugin: pip install hdf5plugin")
+        return dict(hdf5plugin.LZ4())
+    else:
+        raise NotImplementedError(f"Unknown hdf5 compression {compression}")
+
+
+class EpisodeWriter:
+    """
+    Append generated episodes to a zarr dataset as soon as they are produced, on top of `ReplayBuffer.add_episode`.
+    The arrays are resized for every episode and `meta/episode_ends` is updated along the way, so only the episode being
+        written has to be held in memory.
+    """
+    def __init__(self, save_dir, compressor, chunk_len=CHUNK_LEN):
+        os.makedirs(save_dir, exist_ok=True)
+        root = zarr.group(zarr.DirectoryStore(save_dir), overwrite=True)
+        self.save_dir = save_dir
+        self.replay_buffer = ReplayBuffer.create_empty_zarr(root=root)
+        self.compressor = compressor
+        self.chunk_len = chunk_len
+        self.value_ranges = {}
+        self.seconds = 0.
+
+    @property
+    def n_episodes(self):
+        return self.replay_buffer.n_episodes
+
+    def add_episode(self, episode):
+        """
+        episode: dict of "state" (T, d_s), "action" (T, d_a) and "point_cloud" (T, n, 6)
+        """
+        start_time = time.perf_counter()
+        data = {name: np.asarray(episode[key], dtype=np.float32) for key, name in ZARR_KEYS.items()}
+        chunks = {name: (self.chunk_len, *value.shape[1:]) for name, value in data.items()}
+        self.replay_buffer.add_episode(data, chunks=chunks, compressors=self.compressor)
+        for name, value in data.items():
+            low, high = self.value_ranges.get(name, (np.inf, -np.inf))
+            self.value_ranges[name] = (min(low, np.min(value)), max(high, np.max(value)))
+        self.seconds += time.perf_counter() - start_time
+
+    def summary(self):
+        cprint(f'-'*50, 'cyan')
+        for name in ["point_cloud", "agent_pos", "action"]:
+            if name in self.replay_buffer.data:
+                low, high = self.value_ranges.get(name, (None, None))
+                cprint(f'{name} shape: {self.replay_buffer.data[name].shape}, range: [{low}, {high}]', 'green')
+        cprint(f'Saved zarr file to {self.save_dir}', 'green')
+
+    def close(self):
+        self.summary()
+        return {"format": "zarr", "path": self.save_dir, "bytes": disk_size(self.save_dir), "seconds": self.seconds}
+
+
+class Hdf5EpisodeWriter:
+    """
+    Append generated episodes to chunked, resizable hdf5 datasets, in the same layout as the zarr dataset.
+    """
+    def __init__(self, save_path, compression="gzip", chunk_len=CHUNK_LEN):
+        import h5py
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        self.save_path = save_path
+        self.file = h5py.File(save_path, 'w')
+        self.compression_kwargs = hdf5_compression_kwargs(compression)
+        self.chunk_len = chunk_len
+        self.episode_ends = []
+        self.seconds = 0.
+
+    def add_episode(self, episode):
+        n_steps = self.episode_ends[-1] if len(self.episode_ends) > 0 else 0
+        self.append_frames(episode, [n_steps + len(episode["state"])])
+
+    def append_frames(self, data, episode_ends=()):
+        """
+        data: dict of "state", "action" and "point_cloud" arrays of consecutive frames
+        episode_ends: ends of the episodes completed by these frames, counted from the start of the file
+        """
+        start_time = time.perf_counter()
+        for key, name in ZARR_KEYS.items():
+            value = np.asarray(data[key], dtype=np.float32)
+            if name not in self.file:
+                self.file.create_dataset(name, shape=(0, *value.shape[1:]), maxshape=(None, *value.shape[1:]), dtype='float32',
+                                         chunks=(self.chunk_len, *value.shape[1:]), **self.compression_kwargs)
+            dataset = self.file[name]
+            n_steps = dataset.shape[0]
+            dataset.resize(n_steps + len(value), axis=0)
+            dataset[n_steps:] = value
+        self.episode_ends.extend(int(end) for end in episode_ends)
+        self.seconds += time.perf_counter() - start_time
+
+    def close(self):
+        start_time = time.perf_counter()
+        self.file.create_dataset('episode_ends', data=np.array(self.episode_ends, dtype=np.int64))
+        self.file.close()
+        self.seconds += time.perf_counter() - start_time
+        cprint(f'Saved hdf5 file to {self.save_path}', 'green')
+        return {"format": "hdf5", "path": self.save_path, "bytes": disk_size(self.save_path), "seconds": self.seconds}
+
+
+def _background_writer_loop(writer_cls, args, kwargs, episode_queue, result_queue):
+    writer = writer_cls(*args, **kwargs)
+    while True:
+        episode = episode_queue.get()
+        if episode is None:
+            break
+        writer.add_episode(episode)
+    result_queue.put(writer.close())
+
+
+class BackgroundWriter:
+    """
+    Run a writer in a separate process fed through a bounded queue, so that its compression overlaps with the generation.
+    """
+    def __init__(self, writer_cls, *args, max_queue_size=8, **kwargs):
+        ctx = multiprocessing.get_context("fork")
+        self.episode_queue = ctx.Queue(maxsize=max_queue_size)
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=_background_writer_loop, args=(writer_cls, args, kwargs, self.episode_queue, self.result_queue), daemon=True)
+        self.process.start()
+
+    def add_episode(self, episode):
+        self.episode_queue.put({key: np.asarray(value) for key, value in episode.items()})
+
+    def close(self):
+        self.episode_queue.put(None)
+        stats = self.result_queue.get()
+        self.process.join()
+        return stats
+
+
+def save_hdf5(hdf5_path, zarr_path, compression="gzip", block_len=10 * CHUNK_LEN):
+    """
+    Export a saved zarr dataset to hdf5, copying block_len frames at a time.
+    """
+    import h5py
+    start_time = time.perf_counter()
+    zarr_root = zarr.open_group(zarr_path, mode='r')
+    with h5py.File(hdf5_path, 'w') as f:
+        for name in ZARR_KEYS.values():
+            array = zarr_root['data'][name]
+            dataset = f.create_dataset(name, shape=array.shape, dtype=array.dtype, chunks=(min(CHUNK_LEN, max(array.shape[0], 1)), *array.shape[1:]),
+                                       **hdf5_compression_kwargs(compression))
+            for start in range(0, array.shape[0], block_len):
+                dataset[start:start+block_len] = array[start:start+block_len]
+        f.create_dataset('episode_ends', data=zarr_root['meta']['episode_ends'][:])
+    cprint(f'Saved hdf5 file to {hdf5_path}', 'green')
+    return {"format": "hdf5", "path": hdf5_path, "bytes": disk_size(hdf5_path), "seconds": time.perf_counter() - start_time}
+
+
+def report_exports(stats):
+    for s in stats:
+        cprint(f"[{s['format']}] {s['bytes'] / 2**20:.1f} MB written in {s['seconds']:.2f}s to {s['path']}", 'cyan')
@@ -1,6 +1,7 @@
 from omegaconf import OmegaConf
 import hydra
 import pathlib
+import sys
 
 from demo_generation.demogen import DemoGen
 
@@ -18,4 +19,17 @@ def main(cfg: OmegaConf):
 
 
 if __name__ == "__main__":
-    main()
+    # --profile: run under cProfile, save the stats to gen_demo.prof and print the slowest functions
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile")
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main)
+        finally:
+            profiler.dump_stats("gen_demo.prof")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+            print("Saved the cProfile stats to gen_demo.prof")
+    else:
+        main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# from the repository root, the outer demo_generation directory would be imported as a namespace package instead of the
+#   demo_generation package inside of it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
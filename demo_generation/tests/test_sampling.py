@@ -0,0 +1,11 @@
+import numpy as np
+import pytest
+from demo_generation.sampling import QMC_MODES, sample_unit_cube
+
+
+@pytest.mark.parametrize("mode", QMC_MODES)
+@pytest.mark.parametrize("n", [0, 1, 7])
+def test_sample_unit_cube_shape(mode, n):
+    points = sample_unit_cube(n, 4, mode, seed=0)
+    assert points.shape == (n, 4)
+    assert np.all((points >= 0) & (points < 1))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from demo_generation.segmentation import SegmentationCache, segment_frames
+
+
+def reference_divide(pcd, bbox_list):
+    """
+    Split a frame into the robot and the objects with one mask per bbox, as `DemoGen.pcd_divide` with the robot first.
+    """
+    masks = [np.all(pcd[:, :3] > bbox[0], axis=1) & np.all(pcd[:, :3] < bbox[1], axis=1) for bbox in np.array(bbox_list)]
+    return [pcd[~np.any(masks, axis=0)]] + [pcd[mask] for mask in masks]
+
+
+@pytest.fixture
+def pcds():
+    rng = np.random.default_rng(0)
+    return rng.uniform(-1, 1, size=(5, 200, 6)).astype(np.float32)
+
+
+BBOX_LIST = [[[-1, -1, -1], [-0.3, 1, 1]], [[0.3, -1, -0.5], [1, 0.5, 1]]]
+
+
+def test_segment_frames_matches_bbox_masks(pcds):
+    labels = segment_frames(pcds, BBOX_LIST)
+    for t, pcd in enumerate(pcds):
+        for k, segment in enumerate(reference_divide(pcd, BBOX_LIST)):
+            np.testing.assert_array_equal(pcd[labels[t] == k], segment)
+
+
+def test_segmentation_cache_divide_matches_reference(pcds):
+    segmentation = SegmentationCache(pcds, BBOX_LIST, names=["robot", "object", "target"])
+    for t, pcd in enumerate(pcds):
+        expected = reference_divide(pcd, BBOX_LIST)
+        for segment, expected_segment in zip(segmentation.divide(pcd, t), expected):
+            np.testing.assert_array_equal(segment, expected_segment)
+        np.testing.assert_array_equal(pcd[segmentation.indices(t, "target")], expected[2])
+        # the grouped frame is the concatenation of the segments, in the order of the names
+        np.testing.assert_array_equal(segmentation.grouped_pcds[t], np.concatenate(expected))
+
+
+def test_inactive_bboxes_stay_in_robot_segment(pcds):
+    active_bboxes = np.ones((len(pcds), len(BBOX_LIST)), dtype=bool)
+    active_bboxes[3:, 0] = False
+    segmentation = SegmentationCache(pcds, BBOX_LIST, active_bboxes)
+    for t, pcd in enumerate(pcds):
+        bbox_list = BBOX_LIST if t < 3 else BBOX_LIST[1:]
+        robot, *objects = reference_divide(pcd, bbox_list)
+        np.testing.assert_array_equal(pcd[segmentation.indices(t, "robot")], robot)
+        np.testing.assert_array_equal(pcd[segmentation.indices(t, 2)], objects[-1])
+        if t >= 3:
+            assert len(segmentation.indices(t, 1)) == 0
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+demogen = pytest.importorskip("demo_generation.demogen")
+from demo_generation.segmentation import SegmentationCache
+
+DemoGen = demogen.DemoGen
+
+
+def reference_step_actions(start_pos, end_pos, n_frames, reverse=False):
+    """
+    Step actions of a motion segment, as planned one step at a time before the closed form of `DemoGen.motion_step_actions`.
+    """
+    step_actions = []
+    xy_stage_frame = n_frames
+    z_action = end_pos[2] - start_pos[2]
+    if z_action != 0:
+        z_action = np.sign(z_action) * round(np.abs(z_action), 3)
+        for _ in range(int(np.abs(z_action) / 0.015)):
+            step_actions.append(np.array([0, 0, np.sign(z_action) * 0.015]))
+            xy_stage_frame -= 1
+    if xy_stage_frame > 0:
+        xy_action = (end_pos[:2] - start_pos[:2]) / xy_stage_frame
+        step_actions.extend(np.array([*xy_action, 0]) for _ in range(xy_stage_frame))
+    return np.array(step_actions[::-1] if reverse else step_actions)
+
+
+@pytest.fixture
+def source():
+    """
+    A source demo of 6 frames with 40 points, the object points around x=-0.5 and the target points around x=0.5.
+    """
+    rng = np.random.default_rng(0)
+    n_frames, n_points = 6, 40
+    pcds = rng.uniform(-0.2, 0.2, size=(n_frames, n_points, 6)).astype(np.float32)
+    pcds[:, :10, 0] -= 0.5
+    pcds[:, 10:20, 0] += 0.5
+    bbox_list = [[[-0.8, -1, -1], [-0.3, 1, 1]], [[0.3, -1, -1], [0.8, 1, 1]]]
+    demo = {
+        "state": rng.normal(size=(n_frames, 7)).astype(np.float32),
+        "action": rng.normal(size=(n_frames, 7)).astype(np.float32),
+        "point_cloud": pcds,
+    }
+    return demo, bbox_list
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_motion_step_actions_matches_reference(reverse):
+    rng = np.random.default_rng(1)
+    start_pos = rng.uniform(-0.1, 0.1, size=3)
+    end_pos = start_pos + rng.uniform(-0.1, 0.1, size=(5, 3))
+    batched = DemoGen.motion_step_actions(start_pos, end_pos, 20, reverse=reverse)
+    assert batched.shape == (5, 20, 3)
+    for n in range(len(end_pos)):
+        expected = reference_step_actions(start_pos, end_pos[n], 20, reverse=reverse)
+        np.testing.assert_allclose(batched[n], expected, atol=1e-12)
+        np.testing.assert_allclose(DemoGen.motion_step_actions(start_pos, end_pos[n], 20, reverse=reverse), expected, atol=1e-12)
+
+
+def test_synthesize_episodes_matches_per_frame_translation(source):
+    demo, bbox_list = source
+    n_frames = len(demo["state"])
+    segmentation = SegmentationCache(demo["point_cloud"], bbox_list)
+    rng = np.random.default_rng(2)
+    segment_trans = rng.uniform(-0.1, 0.1, size=(3, n_frames, 3, 3))
+    actions = rng.normal(size=(3, n_frames, 7))
+    episodes = DemoGen.synthesize_episodes(demo, segmentation, segment_trans, actions)
+
+    for n in range(len(segment_trans)):
+        for t in range(n_frames):
+            pcd_obj, pcd_tar, pcd_robot = DemoGen.pcd_divide(demo["point_cloud"][t], bbox_list)
+            expected = np.concatenate([DemoGen.pcd_translate(pcd, trans) for pcd, trans in zip([pcd_robot, pcd_obj, pcd_tar], segment_trans[n, t])])
+            np.testing.assert_allclose(episodes["point_cloud"][n, t], expected, atol=1e-6)
+        state = demo["state"].copy()
+        state[:, :3] += segment_trans[n, :, 0]
+        np.testing.assert_allclose(episodes["state"][n], state, atol=1e-6)
+    np.testing.assert_array_equal(episodes["action"], actions)
+
+
+def test_synthesize_episodes_frames_slice(source):
+    demo, bbox_list = source
+    segmentation = SegmentationCache(demo["point_cloud"], bbox_list)
+    segment_trans = np.random.default_rng(3).uniform(-0.1, 0.1, size=(2, 6, 3, 3))
+    actions = np.zeros((2, 6, 7))
+    episodes = DemoGen.synthesize_episodes(demo, segmentation, segment_trans, actions)
+    frames = slice(2, 5)
+    window = DemoGen.synthesize_episodes(demo, segmentation, segment_trans[:, frames], actions[:, frames], frames)
+    for key in ["state", "action", "point_cloud"]:
+        np.testing.assert_array_equal(window[key], episodes[key][:, frames])
@@ -0,0 +1,178 @@
+from typing import Dict
+import torch
+import numpy as np
+import copy
+from omegaconf import OmegaConf
+from diffusion_policies.common.pytorch_util import dict_apply
+from diffusion_policies.common.sampler import create_indices
+from diffusion_policies.model_dp3.common.normalizer import LinearNormalizer
+from diffusion_policies.dataset.base_dataset import BasePointcloudDataset
+
+class DemoGenDataset(BasePointcloudDataset):
+    """
+    Synthesize the DemoGen demos of a source dataset on the fly instead of reading a generated zarr.
+    Only the parsed source demos and their segmentations are kept in memory. Every epoch draws n_variants_per_source
+        translation vectors per source demo with a sampler seeded by (seed, epoch), and __getitem__ synthesizes only the
+        frames of its sample, so the augmentation runs in the DataLoader workers.
+    The samples are laid out like in `PandaDataset`, as if the variants were episodes of a generated zarr.
+    """
+    def __init__(self,
+            demogen_config,
+            data_root=None,
+            horizon=1,
+            pad_before=0,
+            pad_after=0,
+            seed=42,
+            val_ratio=0.0,
+            n_variants_per_source=64,
+            mode="random",
+            n_points=None,
+            n_normalizer_variants=16,
+            task_name=None,
+            ):
+        """
+        demogen_config: path of a demo_generation config, e.g. demo_generation/config/flower.yaml, or the config itself
+        data_root: overrides the data_root of the config, the folder of datasets/source and sam_mask
+        val_ratio: the validation set has round(n_variants_per_source * val_ratio) variants per source demo, drawn once from
+            a separate seed stream
+        mode: translation sampler, "random" or one of the evenly covering samplers of demo_generation.sampling.QMC_MODES
+        n_points: points per frame, overrides generation.resample.n_points of the config
+        n_normalizer_variants: variants per source demo synthesized to fit the normalizer
+        """
+        super().__init__()
+        try:
+            from demo_generation.demogen import DemoGen
+            from demo_generation.sampling import QMC_MODES
+        except ImportError:
+            raise ImportError("DemoGenDataset requires the demo_generation package: pip install -e demo_generation")
+        assert mode == "random" or mode in QMC_MODES, f"mode must be random or one of {QMC_MODES}"
+
+        cfg = OmegaConf.load(demogen_config) if isinstance(demogen_config, str) else OmegaConf.create(demogen_config)
+        if data_root is not None:
+            cfg.data_root = data_root
+        cfg.generation.render_video = False
+        if n_points is not None:
+            cfg.generation.resample = OmegaConf.merge(cfg.generation.get("resample", {}), {"n_points": n_points})
+        self.task_name = task_name
+        self.generator = DemoGen(cfg)
+        self.generator.prepare_sources()
+        self.source_lengths = self.generator.replay_buffer.episode_lengths
+
+        self.seed = seed
+        self.mode = mode
+        self.horizon = horizon
+        self.pad_before = pad_before
+        self.pad_after = pad_after
+        self.n_normalizer_variants = n_normalizer_variants
+        self.n_val_variants = int(round(n_variants_per_source * val_ratio)) if val_ratio > 0 else 0
+        self.is_validation = False
+        self._set_variants(n_variants_per_source)
+        self.set_epoch(0)
+
+    def _set_variants(self, n_variants):
+        """
+        Lay out n_variants episodes per source demo back to back, variant v of source demo i being episode i * n_variants + v.
+        """
+        self.n_variants = n_variants
+        self.episode_ends = np.cumsum(np.repeat(self.source_lengths, n_variants))
+        if len(self.episode_ends) > 0:
+            self.indices = create_indices(self.episode_ends,
+                sequence_length=self.horizon,
+                pad_before=self.pad_before,
+                pad_after=self.pad_after,
+                episode_mask=np.ones(len(self.episode_ends), dtype=bool))
+        else:
+            self.indices = np.zeros((0, 4), dtype=np.int64)
+
+    def _sample_trans_vectors(self, stream):
+        """
+        :return: (n_sources, n_variants, 3 * n_objects) translation vectors drawn from the seed stream (self.seed, *stream)
+        """
+        from demo_generation.sampling import sample_unit_cube, scale_to_range
+        n_objects = len(self.generator.object_names)
+        if self.n_variants == 0:
+            # e.g. the validation set with val_ratio=0
+            return np.zeros((self.generator.n_source_episodes, 0, 3 * n_objects))
+        rng = np.random.default_rng([self.seed, *stream])
+        trans_vectors = []
+        for _ in range(self.generator.n_source_episodes):
+            if self.mode == "random":
+                uv = rng.random((self.n_variants, 2 * n_objects))
+            else:
+                uv = sample_unit_cube(self.n_variants, 2 * n_objects, self.mode, seed=rng)
+            trans_vectors.append(np.concatenate([scale_to_range(uv[:, 2*k:2*k+2], trans_range)
+                                                 for k, trans_range in enumerate(self.generator.trans_ranges)], axis=1))
+        return np.stack(trans_vectors)
+
+    def set_epoch(self, epoch):
+        """
+        Draw the translation vectors of the epoch. The validation variants stay the same in every epoch.
+        """
+        self.epoch = epoch
+        self.trans_vectors = self._sample_trans_vectors((1,) if self.is_validation else (0, epoch))
+
+    def get_validation_dataset(self):
+        val_set = copy.copy(self)
+        val_set.is_validation = True
+        val_set._set_variants(self.n_val_variants)
+        val_set.set_epoch(0)
+        return val_set
+
+    def get_normalizer(self, mode='limits', **kwargs):
+        n_variants = min(self.n_normalizer_variants, self.n_variants)
+        episodes = [self.generator._episodes(i, self.trans_vectors[i, :n_variants]) for i in range(self.generator.n_source_episodes)]
+        data = {
+            'action': np.concatenate([episode['action'].reshape(-1, episode['action'].shape[-1]) for episode in episodes]),
+            'agent_pos': np.concatenate([episode['state'].reshape(-1, episode['state'].shape[-1]) for episode in episodes]),
+            'point_cloud': np.concatenate([episode['point_cloud'].reshape(-1, *episode['point_cloud'].shape[-2:]) for episode in episodes]),
+        }
+        normalizer = LinearNormalizer()
+        normalizer.fit(data=data, last_n_dims=1, mode=mode, **kwargs)
+        return normalizer
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def sample_sequence(self, idx):
+        """
+        Synthesize the frames of sample idx, padded like `SequenceSampler.sample_sequence`.
+        """
+        buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx = self.indices[idx]
+        e = np.searchsorted(self.episode_ends, buffer_start_idx, side='right')
+        i, v = divmod(int(e), self.n_variants)
+        episode_start = self.episode_ends[e] - self.source_lengths[i]
+        frames = slice(buffer_start_idx - episode_start, buffer_end_idx - episode_start)
+        episode = self.generator._episodes(i, self.trans_vectors[i, v:v+1], frames)
+
+        result = dict()
+        for key, name in [('agent_pos', 'state'), ('action', 'action'), ('point_cloud', 'point_cloud')]:
+            sample = episode[name][0]
+            data = sample
+            if (sample_start_idx > 0) or (sample_end_idx < self.horizon):
+                data = np.zeros(shape=(self.horizon,) + sample.shape[1:], dtype=sample.dtype)
+                if sample_start_idx > 0:
+                    data[:sample_start_idx] = sample[0]
+                if sample_end_idx < self.horizon:
+                    data[sample_end_idx:] = sample[-1]
+                data[sample_start_idx:sample_end_idx] = sample
+            result[key] = data
+        return result
+
+    def _sample_to_data(self, sample):
+        agent_pos = sample['agent_pos'][:,].astype(np.float32)
+        point_cloud = sample['point_cloud'][:,].astype(np.float32) # (T, n_points, 6)
+
+        data = {
+            'obs': {
+                'point_cloud': point_cloud, # T, n_points, 6
+                'agent_pos': agent_pos, # T, D_pos
+            },
+            'action': sample['action'].astype(np.float32) # T, D_action
+        }
+        return data
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        sample = self.sample_sequence(idx)
+        data = self._sample_to_data(sample)
+        torch_data = dict_apply(data, torch.from_numpy)
+        return torch_data
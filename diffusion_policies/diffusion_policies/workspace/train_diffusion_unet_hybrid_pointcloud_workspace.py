@@ -218,6 +218,9 @@ class TrainDiffusionUnetHybridPointcloudWorkspace(BaseWorkspace):
                 step_log = dict()
                 # ========= train for this epoch ==========
                 train_losses = list()
+                if hasattr(dataset, 'set_epoch'):
+                    # datasets that synthesize their samples, like DemoGenDataset, draw new ones every epoch
+                    dataset.set_epoch(self.epoch)
                 with tqdm.tqdm(train_dataloader, desc=f"Training epoch {self.epoch}", 
                         leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
                     for batch_idx, batch in enumerate(tepoch):
@@ -0,0 +1,34 @@
+import os
+import pathlib
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("demo_generation.demogen")
+from demo_generation.demogen import DemoGen
+from demo_generation.sampling import QMC_MODES
+from diffusion_policies.dataset.demogen_dataset import DemoGenDataset
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parents[2]
+DEMOGEN_CONFIG = REPO_ROOT / "demo_generation" / "demo_generation" / "config" / "flower.yaml"
+DATA_ROOT = REPO_ROOT / "data"
+
+
+def fake_labels(self, pcd, demo_idx, names=None):
+    """
+    Label the points by their x instead of the SAM masks: the lowest 20% as the object, the highest 30% as the target.
+    """
+    x = pcd[:, 0]
+    return np.where(x < np.quantile(x, 0.2), 1, np.where(x > np.quantile(x, 0.7), 2, 0))
+
+
+@pytest.mark.skipif(not os.path.exists(DATA_ROOT / "datasets" / "source" / "flower.zarr"), reason="requires the flower source demos")
+@pytest.mark.parametrize("mode", ["random", *QMC_MODES])
+def test_validation_dataset_without_val_ratio(monkeypatch, mode):
+    monkeypatch.setattr(DemoGen, "get_objects_labels_from_sam_masks", fake_labels)
+    dataset = DemoGenDataset(str(DEMOGEN_CONFIG), data_root=str(DATA_ROOT), horizon=4, n_variants_per_source=2,
+                             val_ratio=0.0, mode=mode)
+    val_set = dataset.get_validation_dataset()
+    assert len(val_set) == 0
+    assert val_set.trans_vectors.shape[:2] == (dataset.generator.n_source_episodes, 0)
+    assert len(dataset) > 0
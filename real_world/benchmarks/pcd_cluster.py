@@ -0,0 +1,71 @@
+"""
+Compare the latency of the outlier removal of `pcd_cluster` with sklearn DBSCAN and with `voxel_dbscan`.
+Usage: python benchmarks/pcd_cluster.py [--frames data/moon.npy ...] [--n_repeats 20]
+    --frames: raw L515 frames saved with np.save, e.g. by `python utils/pcd_process.py`. They are cropped with `pcd_crop`
+        like in `PandaOYhandEnv.get_obs`. Without frames, a synthetic tabletop scene with sparse outliers is used.
+"""
+import os
+import sys
+import argparse
+import time
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from pcd_process import pcd_config, pcd_crop, voxel_dbscan
+
+
+def synthetic_frame(n_points=60000, seed=0):
+    """
+    Cropped tabletop scene: the table plane, a few objects and the hand, with the sparse flying pixels of a depth camera.
+    """
+    rng = np.random.default_rng(seed)
+    n_table, n_outliers = n_points // 2, n_points // 100
+    table = np.stack([rng.uniform(0.2, 0.8, n_table), rng.uniform(-0.66, 0.6, n_table), rng.normal(0.01, 0.002, n_table)], axis=1)
+    centers = rng.uniform([0.3, -0.4, 0.05], [0.7, 0.4, 0.3], (4, 3))
+    n_objects = n_points - n_table - n_outliers
+    objects = centers[rng.integers(0, len(centers), n_objects)] + rng.normal(0, 0.025, (n_objects, 3))
+    outliers = rng.uniform([0.2, -0.66, 0.005], [0.8, 0.6, 0.45], (n_outliers, 3))
+    xyz = np.concatenate([table, objects, outliers])
+    return np.concatenate([xyz, rng.uniform(0, 255, (len(xyz), 3))], axis=1)
+
+
+def keep_mask(labels, outlier_count):
+    """
+    Points kept by `pcd_cluster`: not noise and in a cluster of at least outlier_count points.
+    """
+    unique_labels, counts = np.unique(labels, return_counts=True)
+    outlier_labels = np.append(unique_labels[counts < outlier_count], -1)
+    return ~np.isin(labels, outlier_labels)
+
+
+def timeit(fn, n_repeats):
+    times = []
+    for _ in range(n_repeats):
+        start_time = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start_time)
+    return result, np.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", nargs="*", default=[])
+    parser.add_argument("--n_repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    frames = [pcd_crop(np.load(path).astype(np.float64)) for path in args.frames] or [synthetic_frame(seed=seed) for seed in range(3)]
+    # compile
+    voxel_dbscan(frames[0][:100, :3], pcd_config.outlier_distance)
+
+    rng = np.random.default_rng(0)
+    for k, frame in enumerate(frames):
+        points = frame[rng.choice(len(frame), pcd_config.random_drop_points, replace=False)]
+        xyz = points[:, :3]
+        labels_dbscan, t_dbscan = timeit(lambda: DBSCAN(eps=pcd_config.outlier_distance, min_samples=10).fit_predict(xyz), args.n_repeats)
+        labels_voxel, t_voxel = timeit(lambda: voxel_dbscan(xyz, pcd_config.outlier_distance, min_samples=10), args.n_repeats)
+        keep_dbscan, keep_voxel = keep_mask(labels_dbscan, pcd_config.outlier_count), keep_mask(labels_voxel, pcd_config.outlier_count)
+        print(f"frame {k} ({len(frame)} points after crop, {len(points)} kept by the random drop)")
+        print(f"  sklearn DBSCAN: {t_dbscan * 1e3:8.2f} ms, {keep_dbscan.sum()} points kept, {labels_dbscan.max() + 1} clusters")
+        print(f"  voxel_dbscan  : {t_voxel * 1e3:8.2f} ms, {keep_voxel.sum()} points kept, {labels_voxel.max() + 1} clusters, "
+              f"speedup {t_dbscan / t_voxel:.1f}x, same keep/drop decision for {np.mean(keep_dbscan == keep_voxel) * 100:.2f}% of the points")
@@ -0,0 +1,56 @@
+"""
+Compare the latency of `pcd_crop` and of the fused crop of `PointCloudPreprocessor`.
+Usage: python benchmarks/pcd_crop.py [--frames data/moon.npy ...] [--n_repeats 20]
+    --frames: raw L515 frames saved with np.save, e.g. by `python utils/pcd_process.py`. Without frames, a synthetic frame
+        with 640x480 points spread around the workspace is used.
+"""
+import os
+import sys
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from pcd_process import pcd_crop, PointCloudPreprocessor
+
+
+def synthetic_frame(preprocessor, n_points=640 * 480, seed=0):
+    """
+    Raw frame whose points, in the robot base frame, are uniform in a box about 10 times as large as the workspace.
+    """
+    rng = np.random.default_rng(seed)
+    xyz = rng.uniform([-0.5, -1.5, -0.5], [1.5, 1.5, 1.5], (n_points, 3))
+    raw2robot = np.concatenate([preprocessor.matrix, [[0, 0, 0, 1]]])
+    raw_xyz = np.concatenate([xyz, np.ones((n_points, 1))], axis=1) @ np.linalg.inv(raw2robot).T
+    return np.concatenate([raw_xyz[:, :3], rng.uniform(0, 255, (n_points, 3))], axis=1)
+
+
+def timeit(fn, n_repeats):
+    times = []
+    for _ in range(n_repeats):
+        start_time = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start_time)
+    return result, np.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", nargs="*", default=[])
+    parser.add_argument("--n_repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    preprocessor = PointCloudPreprocessor()
+    frames = [np.load(path).astype(np.float64) for path in args.frames] or [synthetic_frame(preprocessor, seed=seed) for seed in range(3)]
+    # compile
+    preprocessor.crop(frames[0][:100])
+
+    for k, frame in enumerate(frames):
+        # pcd_crop writes the transformed points into its input
+        cropped, t_crop = timeit(lambda: pcd_crop(frame.copy()), args.n_repeats)
+        _, t_copy = timeit(lambda: frame.copy(), args.n_repeats)
+        fused, t_fused = timeit(lambda: preprocessor.crop(frame), args.n_repeats)
+        print(f"frame {k} ({len(frame)} points, {len(cropped)} in the workspace)")
+        print(f"  pcd_crop                 : {(t_crop - t_copy) * 1e3:8.2f} ms")
+        print(f"  PointCloudPreprocessor   : {t_fused * 1e3:8.2f} ms, speedup {(t_crop - t_copy) / t_fused:.1f}x, "
+              f"max difference {np.abs(cropped - fused).max() if len(cropped) > 0 else 0.:.2e}")
@@ -1,4 +1,6 @@
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.managers import SharedMemoryManager
 import zarr
 import torch
@@ -22,6 +24,10 @@ N_OBS = 2
 N_ACTIONS = 5
 N_ACTIONS_FINISH = 3
 MAX_EPISODE_STEPS = 100
+# steps of the current chunk executed while the next chunk is inferred. The next chunk is inferred from the observations
+# before these steps and its first LATENCY_STEPS actions, which these steps replace, are skipped. 0 waits for the
+# inference after every chunk
+LATENCY_STEPS = 1
 OBS_KEYS = ['point_cloud', 'agent_pos']
 
 CKPT_PATH = "data/ckpts/demogen0312-jar-dp3_fast-seed0/checkpoints/6328.ckpt"
@@ -35,7 +41,7 @@ def main(cfg: OmegaConf):
     env = PandaOYhandEnv(camera=None)
     env.go_home([0.49, -0., 0.44, 3.14, 0, 0])
     
-    env = PandaOYhandEnv()
+    env = PandaOYhandEnv(threaded_capture=True)
     
     try:
         
@@ -61,26 +67,52 @@ def main(cfg: OmegaConf):
         
         time.sleep(0.1)
         
-        obs = env.get_obs()
-        init_obs=obs
-        init_position=init_obs["agent_pos"]
-        
-        all_obs_dict = {
-            "point_cloud": np.zeros((MAX_EPISODE_STEPS, N_POINTS, 6)),
-            "agent_pos": np.zeros((MAX_EPISODE_STEPS, DIM_ACTION))
-        }
-        all_obs_dict['point_cloud'][0] = obs['point_cloud']
-        all_obs_dict['agent_pos'][0] = obs['agent_pos']
-        
-        all_actions = np.zeros((MAX_EPISODE_STEPS, DIM_ACTION))
-        
+        assert N_OBS - 1 + LATENCY_STEPS + N_ACTIONS <= HORIZON, "the predicted actions must cover the skipped steps and the chunk"
+        assert N_ACTIONS - LATENCY_STEPS >= N_OBS - 1, "the observations of the next chunk must be taken during the current chunk"
+        # the N_OBS newest observations; only the steps whose observation the policy consumes are observed
+        obs_history = deque(maxlen=N_OBS)
+        # each initial observation waits for a frame captured after the call, so they are not the same frame
+        obs_history.append(env.get_obs(after=time.time()))
+        obs_history.append(env.get_obs(after=time.time()))
+
+        def predict(np_obs_dict):
+            """
+            Runs in the inference thread.
+            :return: (HORIZON, DIM_ACTION) predicted actions, the action of the step of the last observation first at N_OBS - 1
+            """
+            obs_dict = dict_apply(np_obs_dict, lambda x: torch.from_numpy(x).to(device=device))
+            with torch.no_grad():
+                obs_dict_input = {}  # flush unused keys
+                for key in OBS_KEYS:
+                    obs_dict_input[key] = obs_dict[key].unsqueeze(0)
+                action_dict = policy.predict_action(obs_dict_input)
+            np_action_dict = dict_apply(action_dict, lambda x: x.detach().to('cpu').numpy())
+            return np.squeeze(np_action_dict['action_pred'], axis=0)
+
+        def start_inference():
+            np_obs_dict = {key: np.stack([obs[key] for obs in obs_history]) for key in OBS_KEYS}
+            return executor.submit(predict, np_obs_dict), time.time()
 
-        with SharedMemoryManager() as shm_manager:
-            with KeystrokeCounter() as key_counter:
-                stop=False
-                finish = False
-                action_idx = 1
-                while not stop and action_idx < MAX_EPISODE_STEPS:
+        with SharedMemoryManager() as shm_manager, KeystrokeCounter() as key_counter, ThreadPoolExecutor(max_workers=1) as executor:
+            stop = False
+            finish = False
+            action_idx = 1
+            # the first chunk is inferred with the robot at rest, so none of its actions are skipped
+            inference, inference_start = start_inference()
+            n_skipped = 0
+            # time.time() at the end of the last motion
+            motion_end = None
+            while not stop and action_idx < MAX_EPISODE_STEPS:
+                wait_start = time.time()
+                actions_pred = inference.result()
+                cprint(f"inference {time.time() - inference_start:.3f}s, waited {time.time() - wait_start:.3f}s", "cyan")
+                actions = actions_pred[N_OBS - 1 + n_skipped:N_OBS - 1 + n_skipped + N_ACTIONS]
+                finish = check_finish(actions)
+                # the next chunk starts at next_idx and is inferred before the step launch_idx
+                next_idx = action_idx + N_ACTIONS
+                launch_idx = next_idx - LATENCY_STEPS
+                infer_next = not finish and next_idx < MAX_EPISODE_STEPS
+                for action_todo in actions:
                     print("action_idx:", action_idx)
 
                     press_events = key_counter.get_press_events()
@@ -88,55 +120,37 @@ def main(cfg: OmegaConf):
                         if key_stroke == KeyCode(char='q'):
                             # Exit program
                             stop = True
-                    
-                    # update obs[i]
-                    obs = env.get_obs()
-                    all_obs_dict['point_cloud'][action_idx] = obs['point_cloud']
-                    all_obs_dict['agent_pos'][action_idx] = obs['agent_pos']
-                    
-                    # update obs[0, 1] -> action[1, 2, 3]; obs[3, 4] -> action[4, 5, 6]
-                    if action_idx % N_ACTIONS == 1:
-                        if finish:
-                            for ii in range(N_ACTIONS_FINISH):
-                                action_todo = all_actions[action_idx+ii]
-                                obs, reward, done, info = env.step(action_todo)
-                            break
-                        
-                        np_obs_dict = {
-                            'point_cloud': all_obs_dict['point_cloud'][action_idx-N_OBS+1:action_idx+1],
-                            'agent_pos': all_obs_dict['agent_pos'][action_idx-N_OBS+1:action_idx+1]
-                        }
-                        # print("arm action:", obs['agent_pos'][:, :6])
-                        # print(np_obs_dict['point_cloud'].shape)
-                        # print("dict keys:", np_obs_dict.keys())
-                        obs_dict = dict_apply(np_obs_dict, lambda x: torch.from_numpy(x).to(device=device))
-                        with torch.no_grad():
-                            obs_dict_input = {}  # flush unused keys
-                            for key in OBS_KEYS:
-                                obs_dict_input[key] = obs_dict[key].unsqueeze(0)
-                            action_dict = policy.predict_action(obs_dict_input)
-
-                        np_action_dict = dict_apply(action_dict, lambda x: x.detach().to('cpu').numpy())
-                        # action = np_action_dict['action'].squeeze(0)
-                        # print("np_action_dict['action'] shape:", np_action_dict['action'].shape)
-                        all_actions[action_idx:action_idx+N_ACTIONS] = np.squeeze(np_action_dict['action'])
-                        
-                        finish = check_finish(np.squeeze(np_action_dict['action']))
-                        
-                        if finish:
-                            last_action = all_actions[action_idx+N_ACTIONS-1].copy()
-                            height_offsets = np.zeros((N_ACTIONS_FINISH, 12))
-                            height_offsets[:, 2] = np.linspace(0.03, 0.03 * N_ACTIONS_FINISH, N_ACTIONS_FINISH)
-                            finish_actions = np.tile(last_action, (N_ACTIONS_FINISH, 1)) + height_offsets
-                            finish_actions[:, 5] = -2.4
-                            all_actions[action_idx+N_ACTIONS:action_idx+N_ACTIONS+N_ACTIONS_FINISH] = finish_actions
-                        
-                    action_todo = all_actions[action_idx]
+                    if stop or action_idx >= MAX_EPISODE_STEPS:
+                        break
+
+                    if infer_next and launch_idx - N_OBS < action_idx <= launch_idx:
+                        # observation of the robot after the previous step, from a frame captured after its motion
+                        obs_history.append(env.get_obs(after=motion_end))
+                    if infer_next and action_idx == launch_idx:
+                        inference, inference_start = start_inference()
+                        n_skipped = LATENCY_STEPS
+
+                    action_todo = action_todo.copy()
                     if action_todo[2] < 0.17:    # safety
                         action_todo[2] = 0.17
-                    obs, reward, done, info = env.step(action_todo)
-                    
-                    action_idx+=1
+                    env.step(action_todo, with_obs=False)
+                    motion_end = time.time()
+                    action_idx += 1
+
+                if infer_next and not stop and LATENCY_STEPS == 0:
+                    obs_history.append(env.get_obs(after=motion_end))
+                    inference, inference_start = start_inference()
+                    n_skipped = 0
+
+                if finish and not stop:
+                    last_action = actions[-1].copy()
+                    height_offsets = np.zeros((N_ACTIONS_FINISH, 12))
+                    height_offsets[:, 2] = np.linspace(0.03, 0.03 * N_ACTIONS_FINISH, N_ACTIONS_FINISH)
+                    finish_actions = np.tile(last_action, (N_ACTIONS_FINISH, 1)) + height_offsets
+                    finish_actions[:, 5] = -2.4
+                    for action_todo in finish_actions:
+                        env.step(action_todo, with_obs=False)
+                    break
     finally:
         env.stop()
                 
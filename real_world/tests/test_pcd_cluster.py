@@ -0,0 +1,41 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+pcd_process = pytest.importorskip("pcd_process")
+DBSCAN = pytest.importorskip("sklearn.cluster").DBSCAN
+
+
+def scene(n_points=6000, seed=0):
+    """
+    A table plane, a few objects and sparse outliers, at the scale of a cropped frame.
+    """
+    rng = np.random.default_rng(seed)
+    n_table, n_outliers = n_points // 2, n_points // 50
+    table = np.stack([rng.uniform(0.2, 0.8, n_table), rng.uniform(-0.6, 0.6, n_table), rng.normal(0.01, 0.002, n_table)], axis=1)
+    centers = rng.uniform([0.3, -0.4, 0.05], [0.7, 0.4, 0.3], (4, 3))
+    n_objects = n_points - n_table - n_outliers
+    objects = centers[rng.integers(0, len(centers), n_objects)] + rng.normal(0, 0.025, (n_objects, 3))
+    outliers = rng.uniform([0.2, -0.6, 0.005], [0.8, 0.6, 0.45], (n_outliers, 3))
+    return np.concatenate([table, objects, outliers])
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+@pytest.mark.parametrize("eps", [0.02, 0.05])
+def test_voxel_dbscan_matches_sklearn(seed, eps):
+    xyz = scene(seed=seed)
+    expected = DBSCAN(eps=eps, min_samples=10).fit(xyz)
+    labels = pcd_process.voxel_dbscan(xyz, eps, min_samples=10)
+
+    np.testing.assert_array_equal(labels == -1, expected.labels_ == -1)
+    # the core points form the same clusters, only a border point within eps of several clusters may join another one
+    core = expected.core_sample_indices_
+    pairs = np.unique(np.stack([expected.labels_[core], labels[core]], axis=1), axis=0)
+    assert len(np.unique(pairs[:, 0])) == len(np.unique(pairs[:, 1])) == len(pairs)
+    assert labels.max() + 1 == expected.labels_.max() + 1
+
+
+def test_voxel_dbscan_empty():
+    assert pcd_process.voxel_dbscan(np.zeros((0, 3)), 0.02).shape == (0,)
@@ -8,7 +8,7 @@ import cv2
 from scipy.spatial.transform import Rotation as R,Slerp
 
 from realsense_camera import RealSense_Camera
-from pcd_process import preprocess_point_cloud, pcd_crop, pcd_cluster
+from pcd_process import preprocess_point_cloud, pcd_crop, pcd_cluster, PointCloudPreprocessor
 
 from pcd_visualizer import visualize_pointcloud
 
@@ -18,7 +18,11 @@ ARM_HOME = np.array([0.49, 0.01, 0.44, 3.14, 0, 2.4])
 # ARM_HOME = np.array([0.54, -0.35, 0.29, 3.14, 0, 2.4])  # left
 
 class PandaOYhandEnv:
-    def __init__(self, camera="L515"):
+    def __init__(self, camera="L515", threaded_capture=False):
+        """
+        threaded_capture: capture and preprocess the camera frames in a background thread, so that get_obs returns the
+            newest preprocessed frame without waiting for the camera
+        """
         
         self.arm_action_dim = 6
         self.hand_action_dim = 6
@@ -69,6 +73,11 @@ class PandaOYhandEnv:
         if camera is not None:
             self.realsense_camera = RealSense_Camera(type=camera, id=CAMERA_ID)
             self.realsense_camera.prepare()
+        self.pcd_preprocessor = PointCloudPreprocessor()
+        self.threaded_capture = threaded_capture and camera is not None
+        if self.threaded_capture:
+            # a preprocessor of its own, whose buffer and generator are only used by the capture thread
+            self.realsense_camera.start_capture(preprocess=PointCloudPreprocessor())
         
         # self.go_home()
     
@@ -79,6 +88,8 @@ class PandaOYhandEnv:
 
     def stop(self):
         print("Stop receiver...")
+        if self.threaded_capture:
+            self.realsense_camera.stop_capture()
         # Stop the UDP receiver of the FSR
         #self.force_sensor.stop()  
         
@@ -91,17 +102,18 @@ class PandaOYhandEnv:
         self.arm.start_cartesian_impedance()
         self.latest_arm_action = arm_home
 
-    def step(self, action):
+    def step(self, action, with_obs=True):
         """
         arm action: x, y, z, euler-z, euler-y, euler-x
         gripper action: -1 or 1
+        with_obs: return the observation after the action, None otherwise
         """
         # print("env step action:", action)
         assert len(action) == self.arm_action_dim + self.hand_action_dim
         arm_action = action[:self.arm_action_dim]
         hand_action = action[self.arm_action_dim:]
         self.move_robot(arm_action, hand_action)
-        obs_dict = self.get_obs()
+        obs_dict = self.get_obs() if with_obs else None
         return obs_dict, 0, False, {}
 
     def render(self, mode=None):
@@ -110,7 +122,11 @@ class PandaOYhandEnv:
         return rgb
         
     def get_point_cloud_with_image(self):
-        point_cloud, rgbd_frame = self.realsense_camera.get_frame()
+        # with threaded_capture, the point cloud is already preprocessed
+        if self.threaded_capture:
+            point_cloud, rgbd_frame, _ = self.realsense_camera.get_latest_frame()
+        else:
+            point_cloud, rgbd_frame = self.realsense_camera.get_frame()
         return point_cloud, rgbd_frame
 
     def get_robot_state(self):
@@ -137,20 +153,30 @@ class PandaOYhandEnv:
     def move_hand(self, hand_action):
         self.hand.set_pos(hand_action)
     
-    def get_obs(self, smooth=False):
-        robot_state = self.get_robot_state()
-        point_cloud, rgbd_frame = self.get_point_cloud_with_image()
-        #print(point_cloud.shape)
-        # point_cloud = preprocess_point_cloud(points=point_cloud)
-        # visualize_pointcloud(point_cloud)
-        
-        point_cloud = pcd_crop(point_cloud)
-        
-        # visualize_pointcloud(point_cloud)
-        
-        if smooth:
-            self.update_arm(self.latest_arm_action)
-        point_cloud = pcd_cluster(point_cloud)
+    def get_obs(self, smooth=False, after=None):
+        """
+        after: with threaded_capture, time.time() before which the point cloud must not have been captured
+        """
+        # the robot state is read once the frame is there, so that it is not older than the point cloud
+        if self.threaded_capture:
+            point_cloud, rgbd_frame, _ = self.realsense_camera.get_latest_frame(after=after)
+            robot_state = self.get_robot_state()
+            if smooth:
+                self.update_arm(self.latest_arm_action)
+        else:
+            point_cloud, rgbd_frame = self.get_point_cloud_with_image()
+            robot_state = self.get_robot_state()
+            #print(point_cloud.shape)
+            # point_cloud = preprocess_point_cloud(points=point_cloud)
+            # visualize_pointcloud(point_cloud)
+
+            point_cloud = self.pcd_preprocessor.crop(point_cloud)
+
+            # visualize_pointcloud(point_cloud)
+
+            if smooth:
+                self.update_arm(self.latest_arm_action)
+            point_cloud = pcd_cluster(point_cloud)
         
         # visualize_pointcloud(point_cloud)
         
@@ -7,7 +7,7 @@ from termcolor import cprint
 
 from scipy.spatial.transform import Rotation as R
 import fpsample
-from sklearn.cluster import DBSCAN
+import numba
 from time import time
 import pcd_visualizer
 from dataclasses import dataclass, field
@@ -52,6 +52,8 @@ class PCDProcConfig:
     outlier_count: int
     n_points: int
     work_space: List[List[float]]
+    # "voxel": `voxel_dbscan`, "dbscan": sklearn DBSCAN
+    outlier_method: str = "voxel"
 
 pcd_config = PCDProcConfig(
     random_drop_points=5000,
@@ -101,19 +103,194 @@ def pcd_crop(points, cfg=pcd_config, debug=False):
     return points
 
 
-def pcd_cluster(points, cfg=pcd_config, debug = False):
+@numba.njit(cache=True)
+def _crop_transform(points, matrix, low, high, out):
+    """
+    points: (n, c) raw points, xyz then the other channels
+    matrix: (3, 4) raw xyz to the robot base frame
+    low, high: (3,) workspace box in the robot base frame
+    out: (>= n, c) buffer, the points in the box are written to its first rows with xyz in the robot base frame
+    :return: number of points in the box
+    """
+    k = 0
+    for i in range(points.shape[0]):
+        # the rows of matrix are the planes of the workspace box in the raw frame, a point is dropped at the first plane it is outside of
+        x = matrix[0, 0] * points[i, 0] + matrix[0, 1] * points[i, 1] + matrix[0, 2] * points[i, 2] + matrix[0, 3]
+        if x <= low[0] or x >= high[0]:
+            continue
+        y = matrix[1, 0] * points[i, 0] + matrix[1, 1] * points[i, 1] + matrix[1, 2] * points[i, 2] + matrix[1, 3]
+        if y <= low[1] or y >= high[1]:
+            continue
+        z = matrix[2, 0] * points[i, 0] + matrix[2, 1] * points[i, 1] + matrix[2, 2] * points[i, 2] + matrix[2, 3]
+        if z <= low[2] or z >= high[2]:
+            continue
+        out[k, 0] = x
+        out[k, 1] = y
+        out[k, 2] = z
+        for j in range(3, points.shape[1]):
+            out[k, j] = points[i, j]
+        k += 1
+    return k
+
+
+class PointCloudPreprocessor:
+    """
+    `pcd_crop` and `pcd_cluster` for every frame of a camera, configured by a `PCDProcConfig`.
+    The crop is one pass over the raw points: the scale, T_link2viz and the extrinsics are composed into one 3x4 matrix
+        when the preprocessor is created, a point is dropped as soon as one of its coordinates is outside of work_space,
+        and only the points inside are written, already transformed, to a buffer reused across frames.
+    Unlike `pcd_crop`, the raw points are left untouched.
+    """
+    def __init__(self, cfg=pcd_config, seed=None):
+        """
+        seed: seed of the generator of the random drop of `pcd_cluster`, owned by the preprocessor so that preprocessors
+            used by different threads do not share random state
+        """
+        self.cfg = cfg
+        self.rng = np.random.default_rng(seed)
+        robot2cam_extrinsic_matrix = np.eye(4)
+        robot2cam_extrinsic_matrix[:3, :3] = R.from_quat(ROBOT2CAM_QUAT).as_matrix()
+        robot2cam_extrinsic_matrix[:3, 3] = ROBOT2CAM_POS
+        scale = np.diag([REALSENSE_SCALE, REALSENSE_SCALE, REALSENSE_SCALE, 1.])
+        self.matrix = np.ascontiguousarray((robot2cam_extrinsic_matrix @ T_link2viz @ scale)[:3])
+        work_space = np.asarray(cfg.work_space, dtype=np.float64)
+        self.low, self.high = np.ascontiguousarray(work_space[:, 0]), np.ascontiguousarray(work_space[:, 1])
+        self.buffer = np.zeros((0, 6))
+
+    def crop(self, points):
+        """
+        Same as `pcd_crop(points.copy())`.
+        :return: view of the buffer, overwritten by the next call
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        if self.buffer.shape[0] < points.shape[0] or self.buffer.shape[1] != points.shape[1]:
+            self.buffer = np.empty_like(points)
+        n = _crop_transform(points, self.matrix, self.low, self.high, self.buffer)
+        return self.buffer[:n]
+
+    def __call__(self, points):
+        return pcd_cluster(self.crop(points), self.cfg, rng=self.rng)
+
+
+@numba.njit(cache=True)
+def _find_root(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@numba.njit(cache=True)
+def _voxel_dbscan(xyz, cell_starts, neighbor_cells, eps, min_samples):
+    """
+    xyz: (n, 3) points sorted by voxel, the points of voxel c are cell_starts[c]:cell_starts[c+1]
+    neighbor_cells: (n_cells, 27) the voxels around every voxel, -1 for the empty ones
+    :return: (n,) root point of the cluster of every point, -1 for noise
+    """
+    n = xyz.shape[0]
+    n_cells = neighbor_cells.shape[0]
+    eps2 = eps * eps
+    n_neighbors = np.zeros(n, dtype=np.int64)
+    for c in range(n_cells):
+        for k in range(27):
+            nc = neighbor_cells[c, k]
+            if nc < 0:
+                continue
+            for p in range(cell_starts[c], cell_starts[c + 1]):
+                for q in range(cell_starts[nc], cell_starts[nc + 1]):
+                    d2 = (xyz[p, 0] - xyz[q, 0]) ** 2 + (xyz[p, 1] - xyz[q, 1]) ** 2 + (xyz[p, 2] - xyz[q, 2]) ** 2
+                    if d2 <= eps2:
+                        n_neighbors[p] += 1
+    core = n_neighbors >= min_samples
+
+    # clusters: connected components of the core points within eps, border points join the cluster of a core neighbor
+    parent = np.arange(n)
+    border_of = np.full(n, -1, dtype=np.int64)
+    for c in range(n_cells):
+        for k in range(27):
+            nc = neighbor_cells[c, k]
+            if nc < 0:
+                continue
+            for p in range(cell_starts[c], cell_starts[c + 1]):
+                if not core[p] and border_of[p] >= 0:
+                    continue
+                for q in range(cell_starts[nc], cell_starts[nc + 1]):
+                    if not core[q] or (core[p] and q <= p):
+                        continue
+                    d2 = (xyz[p, 0] - xyz[q, 0]) ** 2 + (xyz[p, 1] - xyz[q, 1]) ** 2 + (xyz[p, 2] - xyz[q, 2]) ** 2
+                    if d2 > eps2:
+                        continue
+                    if core[p]:
+                        root_p, root_q = _find_root(parent, p), _find_root(parent, q)
+                        if root_p != root_q:
+                            parent[max(root_p, root_q)] = min(root_p, root_q)
+                    else:
+                        border_of[p] = q
+                        break
+
+    roots = np.full(n, -1, dtype=np.int64)
+    for p in range(n):
+        if core[p]:
+            roots[p] = _find_root(parent, p)
+        elif border_of[p] >= 0:
+            roots[p] = _find_root(parent, border_of[p])
+    return roots
+
+
+def voxel_dbscan(points_xyz, eps, min_samples=10):
+    """
+    DBSCAN with the neighbors within eps found in a voxel hash of cell size eps, so only the 27 voxels around a point are
+        searched. Same clusters as sklearn `DBSCAN(eps, min_samples)`, up to which cluster a border point within eps of
+        several clusters joins.
+    :return: (n,) cluster labels, -1 for noise
+    """
+    xyz = np.asarray(points_xyz[..., :3], dtype=np.float64)
+    if len(xyz) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # voxel coordinates shifted by one, so that the voxels around every point have non-negative coordinates
+    cells = np.floor((xyz - xyz.min(axis=0)) / eps).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind="stable")
+    cell_keys, cell_starts = np.unique(keys[order], return_index=True)
+    cell_starts = np.append(cell_starts, len(xyz))
+
+    offsets = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing="ij"), axis=-1).reshape(-1, 3)
+    offset_keys = (offsets[:, 0] * dims[1] + offsets[:, 1]) * dims[2] + offsets[:, 2]
+    query_keys = cell_keys[:, None] + offset_keys
+    neighbor_cells = np.minimum(np.searchsorted(cell_keys, query_keys), len(cell_keys) - 1)
+    neighbor_cells[cell_keys[neighbor_cells] != query_keys] = -1
+
+    roots = _voxel_dbscan(np.ascontiguousarray(xyz[order]), cell_starts, neighbor_cells, eps, min_samples)
+    labels = np.full(len(xyz), -1, dtype=np.int64)
+    clustered = roots >= 0
+    # roots are indices in the sorted order
+    labels[order[clustered]] = np.unique(roots[clustered], return_inverse=True)[1]
+    return labels
+
+
+def pcd_cluster(points, cfg=pcd_config, debug = False, rng=None):
+    """
+    rng: np.random.Generator of the random drop, None for the global np.random state
+    """
     RANDOM_DROP_POINTS = cfg.random_drop_points
     OUTLIER_DISTANCE = cfg.outlier_distance
     OUTLIER_COUNT = cfg.outlier_count
     N_POINTS = cfg.n_points
 
     # Randomly drop points
-    points = points[np.random.choice(points.shape[0], RANDOM_DROP_POINTS, replace=False)]
+    if rng is None:
+        points = points[np.random.choice(points.shape[0], RANDOM_DROP_POINTS, replace=False)]
+    else:
+        points = points[rng.choice(points.shape[0], RANDOM_DROP_POINTS, replace=False)]
     points_xyz = points[..., :3]
 
     # DBSCAN clustering
-    bdscan = DBSCAN(eps=OUTLIER_DISTANCE, min_samples=10)
-    labels = bdscan.fit_predict(points_xyz)
+    if cfg.outlier_method == "dbscan":
+        from sklearn.cluster import DBSCAN
+        labels = DBSCAN(eps=OUTLIER_DISTANCE, min_samples=10).fit_predict(points_xyz)
+    else:
+        labels = voxel_dbscan(points_xyz, OUTLIER_DISTANCE, min_samples=10)
 
     # Then get out of the cluster with less than OUTLIER points or noise
     unique_labels, counts = np.unique(labels, return_counts=True)
@@ -2,12 +2,15 @@
 import numpy as np
 import math
 import time
+import threading
 import cv2
 import pyrealsense2 as rs
 
 # PIXEL_W, PIXEL_H = 640, 480 # default
 DEPTH_PIXEL_W, DEPTH_PIXEL_H = 640, 480 #320, 240
 COLOR_PIXEL_W, COLOR_PIXEL_H = 640, 480 #640, 360
+# flip of the y and z axes applied to the point clouds of the camera
+FLIP_TRANSFORM = np.array([[1, 0, 0, 0], [0, -1, 0, 0], [0, 0, -1, 0], [0, 0, 0, 1]])
 
 
 class CameraInfo():
@@ -48,6 +51,30 @@ def create_point_cloud_from_depth_image(depth, camera, organized=True):
         cloud = cloud.reshape([-1, 3])
     return cloud
 
+def create_pixel_rays(camera, transform=None):
+    """ Points at depth 1 of all the pixels, so that the cloud of a depth image is depth * rays.
+
+        Input:
+            camera: [CameraInfo]
+                camera intrinsics
+            transform: [np.ndarray, (3,3), np.float32]
+                rotation folded into the rays, e.g. an axis flip
+
+        Output:
+            rays: [numpy.ndarray, (H*W,3), numpy.float64]
+                rays of the pixels in row-major order, the cloud of depth is depth.reshape(-1, 1) * rays
+    """
+    xmap = (np.arange(camera.width) - camera.cx) / camera.fx
+    ymap = (np.arange(camera.height) - camera.cy) / camera.fy
+    rays = np.empty((camera.height, camera.width, 3))
+    rays[..., 0] = xmap[np.newaxis, :] / camera.scale
+    rays[..., 1] = ymap[:, np.newaxis] / camera.scale
+    rays[..., 2] = 1. / camera.scale
+    rays = rays.reshape([-1, 3])
+    if transform is not None:
+        rays = np.dot(rays, np.asarray(transform, dtype=np.float64).T)
+    return np.ascontiguousarray(rays)
+
 def transform_point_cloud(cloud, transform, format='4x4'):
     """ Transform points to new coordinates with transformation matrix.
 
@@ -103,14 +130,43 @@ class RealSense_Camera:
         self.align_to = rs.stream.color
         self.align = rs.align(self.align_to)
 
+        # pixel rays and point cloud buffer of the current intrinsics, see _prepare_rays
+        self.intrinsics_key = None
+        self.rays = None
+        self.point_cloud_buffer = None
+        self.frame_time = None
+
+        # background capture, see start_capture
+        self.capture_thread = None
+
     def prepare(self):
         for fid in range(50):
             frames = self.pipeline.wait_for_frames()
             depth_frame = frames.get_depth_frame()
             color_frame = frames.get_color_frame()
 
-    def get_frame(self, remove_bg = False):
+    def _prepare_rays(self, intrinsics):
+        """
+        Compute the pixel rays, with the axis flip of the point cloud folded in, and the point cloud buffer of the
+            intrinsics, once per intrinsics.
+        """
+        key = (intrinsics.width, intrinsics.height, intrinsics.fx, intrinsics.fy, intrinsics.ppx, intrinsics.ppy)
+        if key != self.intrinsics_key:
+            camera = CameraInfo(*key)
+            self.rays = create_pixel_rays(camera, FLIP_TRANSFORM[:3, :3])
+            self.point_cloud_buffer = np.empty((camera.height * camera.width, 6))
+            self.intrinsics_key = key
+
+    def get_frame(self, remove_bg = False, valid_only = False, reuse_buffer = False):
+        """
+        remove_bg: set the color of the pixels further than clipping_distance to grey
+        valid_only: only keep the points of the pixels with a depth, in row-major order
+        reuse_buffer: write the point cloud to a buffer of the camera overwritten by the next call with reuse_buffer,
+            instead of a new array, for callers that consume the point cloud before the next frame
+        :return: point_cloud (H*W or number of valid pixels, 6), xyz then color; rgbd_frame (H, W, 4)
+        """
         frames = self.pipeline.wait_for_frames()
+        self.frame_time = time.time()
         
         color_frame = frames.get_color_frame()
         color_image = np.asanyarray(color_frame.get_data())
@@ -119,40 +175,91 @@ class RealSense_Camera:
         aligned_frames = self.align.process(frames)
         profile = aligned_frames.get_profile()
         intrinsics = profile.as_video_stream_profile().get_intrinsics()
-        camera = CameraInfo(intrinsics.width, intrinsics.height, intrinsics.fx, intrinsics.fy, intrinsics.ppx, intrinsics.ppy)
-        # print(camera)
+        self._prepare_rays(intrinsics)
         depth_frame = aligned_frames.get_depth_frame() 
         
         depth_image = np.asanyarray(depth_frame.get_data())
         
         color_image[:, :, [0,2]] = color_image[:,:,[2,0]]
-        transform = np.array([[1, 0, 0, 0], [0, -1, 0, 0], [0, 0, -1, 0], [0, 0, 0, 1]])
-        
         
         if not remove_bg:
-            point_xyz = create_point_cloud_from_depth_image(depth_image, camera, organized=False)
-            point_xyz = transform_point_cloud(point_xyz, transform)
             rgbd_frame = np.concatenate([color_image, np.expand_dims(depth_image, axis=-1)], axis = -1)
             point_color = color_image.reshape(-1, 3)
 
-
         else:
             # Remove background - Set pixels further than clipping_distance to grey
             grey_color = 153
             depth_image_3d = np.dstack((depth_image,depth_image,depth_image)) #depth image is 1 channel, color is 3 channels
             bg_removed = np.where((depth_image_3d > self.clipping_distance) | (depth_image_3d <= 0), grey_color, color_image)
-            point_xyz = create_point_cloud_from_depth_image(depth_image, camera, organized=False)
-            transform = np.array([[1, 0, 0, 0], [0, -1, 0, 0], [0, 0, -1, 0], [0, 0, 0, 1]])
-            point_xyz = transform_point_cloud(point_xyz, transform)
-            point_color = bg_removed.reshape([-1,3])
-            point_color = transform_point_cloud(point_color, transform)
+            point_color = bg_removed.reshape([-1,3]) * np.diag(FLIP_TRANSFORM)[:3]
             rgbd_frame = np.concatenate([bg_removed, np.expand_dims(depth_image, axis=-1)], axis = -1)
 
-        point_cloud = np.concatenate([point_xyz, point_color], axis = 1)
+        depth = depth_image.reshape(-1)
+        rays = self.rays
+        if valid_only:
+            valid = np.flatnonzero(depth)
+            depth, rays, point_color = np.take(depth, valid), np.take(rays, valid, axis=0), np.take(point_color, valid, axis=0)
+        point_cloud = self.point_cloud_buffer[:len(depth)] if reuse_buffer else np.empty((len(depth), 6))
+        np.multiply(depth[:, np.newaxis], rays, out=point_cloud[:, :3])
+        point_cloud[:, 3:] = point_color
 
         return point_cloud, rgbd_frame
 
+    def start_capture(self, preprocess=None, n_slots=4):
+        """
+        Capture frames in a background thread into a ring buffer of the n_slots newest frames, read by get_latest_frame,
+            so that the camera I/O, the alignment and the preprocessing overlap with the caller.
+        preprocess: called in the thread on the point cloud of every frame, e.g. a `PointCloudPreprocessor` not used by any
+            other thread. It must return a new array, without preprocess the point cloud is copied out of the buffer of
+            get_frame.
+        """
+        if self.capture_thread is not None:
+            return
+        self.preprocess = preprocess
+        # slot i % n_slots holds frame i as an immutable (point_cloud, rgbd_frame, timestamp) tuple, and n_captured is
+        # incremented after the slot is written, so readers never see a frame being written and need no lock
+        self.ring = [None] * n_slots
+        self.n_captured = 0
+        self.capture_error = None
+        self.stop_event = threading.Event()
+        self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self.capture_thread.start()
 
-        
+    def _capture_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                point_cloud, rgbd_frame = self.get_frame(reuse_buffer=True)
+                point_cloud = self.preprocess(point_cloud) if self.preprocess is not None else point_cloud.copy()
+            except Exception as e:
+                self.capture_error = e
+                return
+            self.ring[self.n_captured % len(self.ring)] = (point_cloud, rgbd_frame, self.frame_time)
+            self.n_captured += 1
+
+    def get_latest_frame(self, after=None, timeout=1.0):
+        """
+        Newest frame of the capture thread.
+        after: time.time() before which the frame must not have been captured, e.g. the end of a robot motion. Waits for
+            such a frame if the newest one is older.
+        :return: point_cloud, rgbd_frame, timestamp (time.time() when the frame arrived)
+        """
+        assert self.capture_thread is not None, "start_capture must be called before get_latest_frame"
+        deadline = time.time() + timeout
+        while True:
+            if self.capture_error is not None:
+                raise RuntimeError("The capture thread of the camera stopped") from self.capture_error
+            n_captured = self.n_captured
+            if n_captured > 0:
+                frame = self.ring[(n_captured - 1) % len(self.ring)]
+                if after is None or frame[2] >= after:
+                    return frame
+            if time.time() > deadline:
+                raise TimeoutError(f"No frame from the camera in {timeout}s")
+            time.sleep(0.001)
 
-  
\ No newline at end of file
+    def stop_capture(self):
+        if self.capture_thread is None:
+            return
+        self.stop_event.set()
+        self.capture_thread.join()
+        self.capture_thread = None